@@ -0,0 +1,139 @@
+"""Архив записей на FTS5: скорость пакетной вставки и задержка запросов на миллионах строк.
+
+    python benchmarks/bench_archive.py --rows 2000000
+    python benchmarks/bench_archive.py --rows 200000 --queries 500 --db /tmp/archive.db
+
+Строки раскладываются равномерно по ARCHIVE_RETENTION, слова берутся из словаря с распределением Ципфа
+(как в живых новостях: немного частых слов и длинный хвост редких). Меряются /search (все слова, как начало
+слова) и подбор под новое ключевое слово (фраза за последние KEYWORD_BACKFILL_HOURS по подпискам).
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("BOT_TOKEN", "42:BENCHMARK")
+
+import newsbot  # noqa: E402
+
+LATIN = "abcdefghijklmnopqrstuvwxyz"
+CYRILLIC = "абвгдежзийклмнопрстуфхцчшщъыьэюя"
+
+
+def make_vocabulary(size, rng):
+    words = set()
+    while len(words) < size:
+        alphabet = CYRILLIC if rng.random() < 0.5 else LATIN
+        words.add("".join(rng.choice(alphabet) for _ in range(rng.randint(4, 10))))
+    return sorted(words)
+
+
+def summary(samples):
+    samples = sorted(samples)
+    return {"mean_ms": round(statistics.fmean(samples), 3), "p50_ms": round(samples[len(samples) // 2], 3),
+            "p99_ms": round(samples[max(0, int(len(samples) * 0.99) - 1)], 3)}
+
+
+async def load(args, vocabulary, weights, feeds, rng):
+    """Заливает архив пачками через newsbot.insert_archive. Возвращает строк в секунду."""
+    start_at = time.time() - newsbot.ARCHIVE_RETENTION
+    step = newsbot.ARCHIVE_RETENTION / args.rows
+    start = time.perf_counter()
+    for offset in range(0, args.rows, args.batch):
+        count = min(args.batch, args.rows - offset)
+        words = rng.choices(vocabulary, weights, k=count * (args.title_words + args.summary_words))
+        entries = []
+        for i in range(count):
+            chunk = words[i * (args.title_words + args.summary_words):(i + 1) * (args.title_words + args.summary_words)]
+            entries.append((rng.choice(feeds), " ".join(chunk[:args.title_words]), f"https://example.org/{offset + i}",
+                            None, " ".join(chunk[args.title_words:])))
+        async with newsbot.db_pool.transaction() as db:
+            await newsbot.insert_archive(db, entries, start_at + offset * step)
+    return args.rows / (time.perf_counter() - start)
+
+
+async def timed(samples, call):
+    start = time.perf_counter()
+    result = await call
+    samples.append((time.perf_counter() - start) * 1e3)
+    return result
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(args.vocabulary, rng)
+    weights = [1 / rank for rank in range(1, len(vocabulary) + 1)]
+    feeds = [f"Feed {n}" for n in range(args.feeds)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        newsbot.DB_PATH = args.db or os.path.join(tmp, "archive.db")
+        await newsbot.init_db()
+        async with newsbot.db_pool.connection() as db:
+            async with db.execute("SELECT COUNT(*) FROM archive") as cursor:
+                existing = (await cursor.fetchone())[0]
+        insert_rate = None
+        if existing < args.rows:
+            args.rows -= existing
+            insert_rate = round(await load(args, vocabulary, weights, feeds, rng))
+            args.rows += existing
+
+        # Частые слова (голова Ципфа), средние и редкие — у них очень разное число совпадений
+        buckets = {"frequent": vocabulary[:20], "medium": vocabulary[200:2000], "rare": vocabulary[-20000:]}
+        results = {}
+        for bucket, words in buckets.items():
+            search, backfill, hits = [], [], []
+            for _ in range(args.queries):
+                query = " ".join(rng.sample(words, rng.randint(1, 2)))
+                found = await timed(search, newsbot.search_archive(newsbot.fts_query(query)))
+                hits.append(len(found))
+                keyword = rng.choice(words)
+                await timed(backfill, newsbot.search_archive(
+                    newsbot.fts_query(keyword, phrase=True), since=time.time() - newsbot.KEYWORD_BACKFILL_HOURS * 3600,
+                    feed_names=rng.sample(feeds, min(3, len(feeds)))))
+            results[bucket] = {"search": summary(search), "backfill": summary(backfill),
+                               "mean_hits": round(statistics.fmean(hits), 1)}
+
+        prune_start = time.perf_counter()
+        newsbot.ARCHIVE_RETENTION -= 3600  # отрезаем самый старый час
+        pruned = await newsbot.prune_archive()
+        prune_ms = (time.perf_counter() - prune_start) * 1e3
+
+        await newsbot.close_db()
+        size_mb = sum(os.path.getsize(path) for path in
+                      itertools.chain([newsbot.DB_PATH], [newsbot.DB_PATH + "-wal"])
+                      if os.path.exists(path)) / 2 ** 20
+
+    return {
+        "rows": args.rows,
+        "insert_rows_per_s": insert_rate,
+        "db_size_mb": round(size_mb, 1),
+        "queries": results,
+        "prune": {"rows": pruned, "ms": round(prune_ms, 1)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--batch", type=int, default=10_000, help="строк в одной транзакции вставки")
+    parser.add_argument("--feeds", type=int, default=50)
+    parser.add_argument("--vocabulary", type=int, default=100_000)
+    parser.add_argument("--title-words", type=int, default=10)
+    parser.add_argument("--summary-words", type=int, default=30)
+    parser.add_argument("--queries", type=int, default=200, help="запросов на каждую группу слов")
+    parser.add_argument("--db", help="файл базы (переиспользуется между запусками); по умолчанию — временный")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
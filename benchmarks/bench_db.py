@@ -0,0 +1,113 @@
+"""Микро-бенчмарк слоя БД: соединение на каждый вызов (как было) против пула.
+
+    python benchmarks/bench_db.py --ops 2000
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("BOT_TOKEN", "42:BENCHMARK")
+
+import aiosqlite  # noqa: E402
+
+import newsbot  # noqa: E402
+
+
+# --- Старые хелперы: aiosqlite.connect + commit на каждый вызов ---
+async def legacy_get_filter_mode(user_id):
+    async with aiosqlite.connect(newsbot.DB_PATH) as db:
+        async with db.execute("SELECT filter_mode FROM user_settings WHERE user_id = ?", (user_id,)) as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else 'all'
+
+async def legacy_get_user_keywords(user_id):
+    async with aiosqlite.connect(newsbot.DB_PATH) as db:
+        async with db.execute("SELECT keyword FROM keywords WHERE user_id = ?", (user_id,)) as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+async def legacy_toggle_subscription(user_id, feed_name):
+    async with aiosqlite.connect(newsbot.DB_PATH) as db:
+        async with db.execute("SELECT 1 FROM subscriptions WHERE user_id = ? AND feed_name = ?",
+                              (user_id, feed_name)) as cursor:
+            exists = await cursor.fetchone()
+        if exists:
+            await db.execute("DELETE FROM subscriptions WHERE user_id = ? AND feed_name = ?", (user_id, feed_name))
+        else:
+            await db.execute("INSERT INTO subscriptions (user_id, feed_name) VALUES (?, ?)", (user_id, feed_name))
+        await db.commit()
+
+
+async def seed(users, feeds):
+    async with newsbot.db_pool.transaction() as db:
+        await db.executemany("INSERT INTO users (user_id) VALUES (?)", [(u,) for u in range(users)])
+        await db.executemany("INSERT INTO user_settings (user_id, filter_mode) VALUES (?, ?)",
+                             [(u, 'keywords' if u % 2 else 'all') for u in range(users)])
+        await db.executemany("INSERT INTO keywords (user_id, keyword) VALUES (?, ?)",
+                             [(u, f"kw{k}") for u in range(users) for k in range(5)])
+        await db.executemany("INSERT INTO subscriptions (user_id, feed_name) VALUES (?, ?)",
+                             [(u, f"feed{f}") for u in range(users) for f in range(feeds) if (u + f) % 2 == 0])
+
+
+async def measure(ops, call):
+    samples = []
+    for i in range(ops):
+        start = time.perf_counter()
+        await call(i)
+        samples.append((time.perf_counter() - start) * 1e6)
+    samples.sort()
+    return {
+        "mean_us": round(statistics.fmean(samples), 1),
+        "p50_us": round(samples[len(samples) // 2], 1),
+        "p99_us": round(samples[int(len(samples) * 0.99) - 1], 1),
+    }
+
+
+async def run(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        newsbot.DB_PATH = os.path.join(tmp, "bench.db")
+        await newsbot.init_db()
+        await seed(args.users, args.feeds)
+        users, feeds = args.users, args.feeds
+
+        cases = {
+            "get_filter_mode": (lambda i: legacy_get_filter_mode(i % users),
+                                lambda i: newsbot.get_filter_mode(i % users)),
+            "get_user_keywords": (lambda i: legacy_get_user_keywords(i % users),
+                                  lambda i: newsbot.get_user_keywords(i % users)),
+            "toggle_subscription": (lambda i: legacy_toggle_subscription(i % users, "feed0"),
+                                    lambda i: newsbot.toggle_subscription(i % users, "feed0")),
+        }
+        report = {}
+        for name, (legacy, pooled) in cases.items():
+            report[name] = {"per_call_connect": await measure(args.ops, legacy),
+                            "pooled": await measure(args.ops, pooled)}
+
+        # Пакетное чтение: один вызов на весь цикл вместо вызова на ленту
+        feed_names = [f"feed{f}" for f in range(feeds)]
+        report["get_last_links[batch]"] = {"pooled": await measure(args.ops // 10 or 1,
+                                                                   lambda i: newsbot.get_last_links(feed_names))}
+        await newsbot.close_db()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{'operation':<28}{'mode':<18}{'mean µs':>10}{'p50 µs':>10}{'p99 µs':>10}")
+    for name, modes in report.items():
+        for mode, stats in modes.items():
+            print(f"{name:<28}{mode:<18}{stats['mean_us']:>10}{stats['p50_us']:>10}{stats['p99_us']:>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ops", type=int, default=1000, help="вызовов на операцию")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--feeds", type=int, default=10)
+    parser.add_argument("--json", action="store_true", help="вывести результат в JSON")
+    asyncio.run(run(parser.parse_args()))
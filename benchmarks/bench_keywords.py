@@ -0,0 +1,99 @@
+"""Время фильтрации одной новости: перебор слов каждого пользователя против KeywordMatcher.
+
+    python benchmarks/bench_keywords.py --users 10000 --keywords 20
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("BOT_TOKEN", "42:BENCHMARK")
+
+import newsbot  # noqa: E402
+
+LATIN = "abcdefghijklmnopqrstuvwxyz"
+# Без "ё": матчер сводит её к "е", а прямой перебор — нет, и сверка разошлась бы
+CYRILLIC = "абвгдежзийклмнопрстуфхцчшщъыьэюя"
+
+
+def make_vocabulary(size, rng):
+    words = set()
+    while len(words) < size:
+        alphabet = CYRILLIC if rng.random() < 0.5 else LATIN
+        words.add("".join(rng.choice(alphabet) for _ in range(rng.randint(4, 10))))
+    return sorted(words)
+
+
+def make_entry(vocabulary, rng, words=60):
+    text = " ".join(rng.choice(vocabulary) for _ in range(words))
+    return text[:1].upper() + text[1:]
+
+
+def timed(samples, call):
+    start = time.perf_counter()
+    result = call()
+    samples.append((time.perf_counter() - start) * 1e6)
+    return result
+
+
+def summary(samples):
+    samples = sorted(samples)
+    return {"mean_us": round(statistics.fmean(samples), 1), "p50_us": round(samples[len(samples) // 2], 1),
+            "p99_us": round(samples[int(len(samples) * 0.99) - 1], 1)}
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(args.vocabulary, rng)
+    user_keywords = {user_id: rng.sample(vocabulary, args.keywords) for user_id in range(args.users)}
+
+    start = time.perf_counter()
+    matcher = newsbot.KeywordMatcher(whole_words=args.whole_words)
+    matcher.add_many((user_id, word) for user_id, words in user_keywords.items() for word in words)
+    build_ms = (time.perf_counter() - start) * 1e3
+
+    entries = [make_entry(vocabulary, rng) for _ in range(args.entries)]
+    legacy, indexed = [], []
+    for text in entries:
+        lowered = text.lower()
+        expected = timed(legacy, lambda: {user_id for user_id, words in user_keywords.items()
+                                          if any(kw in lowered for kw in words)})
+        got = timed(indexed, lambda: matcher.match(text))
+        if not args.whole_words:
+            assert got == expected, "KeywordMatcher разошёлся с прямым перебором"
+
+    # Инкрементальное обновление: новое слово + первый поиск после него
+    rebuild = []
+    for i in range(20):
+        matcher.add(i, f"новоеслово{i}")
+        timed(rebuild, lambda: matcher.match(entries[0]))
+
+    report = {
+        "users": args.users, "keywords_per_user": args.keywords, "whole_words": args.whole_words,
+        "build_ms": round(build_ms, 1),
+        "per_entry_legacy": summary(legacy),
+        "per_entry_matcher": summary(indexed),
+        "match_after_add": summary(rebuild),
+    }
+    if args.json:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+        return
+    for key, value in report.items():
+        print(f"{key:<20} {value}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--keywords", type=int, default=20, help="слов на пользователя")
+    parser.add_argument("--vocabulary", type=int, default=50000, help="размер общего словаря")
+    parser.add_argument("--entries", type=int, default=50, help="сколько новостей прогнать")
+    parser.add_argument("--whole-words", action="store_true")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="вывести результат в JSON")
+    run(parser.parse_args())
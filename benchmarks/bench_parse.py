@@ -0,0 +1,83 @@
+"""Пропускная способность разбора лент и отзывчивость event loop при разном PARSE_WORKERS.
+
+    python benchmarks/bench_parse.py --docs 40 --items 300 --workers 0,1,2,4
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from email.utils import formatdate
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("BOT_TOKEN", "42:BENCHMARK")
+
+import newsbot  # noqa: E402
+
+
+def make_document(items, summary_words):
+    now = time.time()
+    body = "".join(
+        f"<item><title>Новость номер {i}: рынок и политика</title><link>https://example.com/news/{i}</link>"
+        f"<guid>news-{i}</guid><description>{'Длинный текст новости с подробностями. ' * summary_words}</description>"
+        f"<pubDate>{formatdate(now - i * 60, usegmt=True)}</pubDate></item>"
+        for i in range(items)
+    )
+    return (f'<?xml version="1.0" encoding="utf-8"?><rss version="2.0"><channel><title>Bench</title>'
+            f"{body}</channel></rss>").encode()
+
+
+async def loop_lag_probe(stop, samples, tick=0.005):
+    # Насколько позже положенного просыпается корутина — так же «залипли» бы нажатия кнопок
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(tick)
+        samples.append(time.perf_counter() - start - tick)
+
+
+async def run_workers(workers, document, docs):
+    newsbot.PARSE_WORKERS = workers
+    newsbot.shutdown_parse_pool()
+    await newsbot.parse_feed(document)  # прогрев: старт процессов пула
+    stop, lags = asyncio.Event(), []
+    probe = asyncio.create_task(loop_lag_probe(stop, lags))
+    start = time.perf_counter()
+    results = await asyncio.gather(*(newsbot.parse_feed(document) for _ in range(docs)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await probe
+    newsbot.shutdown_parse_pool()
+    lags.sort()
+    return {
+        "workers": workers,
+        "docs_per_s": round(docs / elapsed, 1),
+        "entries": len(results[0].entries),
+        "loop_lag_p99_ms": round(lags[int(len(lags) * 0.99) - 1] * 1e3, 2) if lags else None,
+        "loop_lag_max_ms": round(lags[-1] * 1e3, 2) if lags else None,
+    }
+
+
+async def main(args):
+    document = make_document(args.items, args.summary_words)
+    report = {"document_kb": round(len(document) / 1024, 1), "docs": args.docs, "cpu_count": os.cpu_count(),
+              "runs": [await run_workers(w, document, args.docs) for w in args.workers]}
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"document {report['document_kb']} KB, {args.docs} docs, {report['cpu_count']} CPU")
+    for run in report["runs"]:
+        print(f"workers={run['workers']:<3} {run['docs_per_s']:>8} docs/s   "
+              f"loop lag p99 {run['loop_lag_p99_ms']} ms, max {run['loop_lag_max_ms']} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, default=40)
+    parser.add_argument("--items", type=int, default=300, help="записей в документе")
+    parser.add_argument("--summary-words", type=int, default=20, help="повторов фразы в описании")
+    parser.add_argument("--workers", type=lambda v: [int(x) for x in v.split(",")], default=[0, 1, 2, 4],
+                        help="размеры пула через запятую; 0 — разбор в потоке")
+    parser.add_argument("--json", action="store_true")
+    asyncio.run(main(parser.parse_args()))
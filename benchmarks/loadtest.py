@@ -0,0 +1,328 @@
+"""Нагрузочный стенд check_news() без интернета и без настоящего Telegram.
+
+Поднимает два локальных сервера:
+  * RSS-сервер с синтетическими лентами (размер окна и число новых записей за цикл настраиваются);
+  * фейковый Bot API, который записывает отправки и умеет отвечать 429/403 и с задержкой.
+
+Настоящий aiogram Bot ходит в фейковый API, настоящий check_news() — в локальные ленты.
+Параметры через запятую перемножаются в сетку сценариев; результат — JSON.
+
+    python benchmarks/loadtest.py --feeds 3,10 --users 500 --keywords 5 --entries 2 --cycles 3
+    python benchmarks/loadtest.py --users 2000 --p429 0.01 --blocked 0.05 --output result.json
+    python benchmarks/loadtest.py --users 5000 --send-rate 30 --interactive-rate 5 --cycles 1
+"""
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import os
+import random
+import re
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from email.utils import formatdate
+from pathlib import Path
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("BOT_TOKEN", "42:BENCHMARK")
+
+from aiogram import Bot  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+from aiohttp import web  # noqa: E402
+
+import newsbot  # noqa: E402
+
+ENTRY_LINK_RE = re.compile(r"/feed/(\d+)/e/(\d+)")
+
+
+class RssServer:
+    """Синтетические ленты: /feed/<n>.xml, новые записи появляются по advance()."""
+
+    def __init__(self, feeds, feed_size, vocabulary, rng):
+        self.feed_size = feed_size
+        self.vocabulary = vocabulary
+        self.rng = rng
+        self.base = ""
+        self.entries = {n: [] for n in range(feeds)}  # новые — в начале
+        self.published = {}  # (feed, entry_id) -> time.time() появления
+        self.requests = 0
+        self.not_modified = 0
+        self._next_id = itertools.count()
+        for n in self.entries:
+            self.advance_feed(n, feed_size)
+
+    def words(self, count):
+        return " ".join(self.rng.choice(self.vocabulary) for _ in range(count))
+
+    def advance_feed(self, n, count):
+        now = time.time()
+        for _ in range(count):
+            entry_id = next(self._next_id)
+            self.entries[n].insert(0, (entry_id, self.words(8).capitalize(), self.words(30), now))
+            self.published[(n, entry_id)] = now
+        del self.entries[n][self.feed_size:]
+
+    def advance(self, count):
+        for n in self.entries:
+            self.advance_feed(n, count)
+
+    def url(self, n):
+        return f"{self.base}/feed/{n}.xml"
+
+    def render(self, n):
+        items = "".join(
+            f"<item><title>{escape(title)}</title><link>{self.base}/feed/{n}/e/{entry_id}</link>"
+            f"<guid>feed{n}-{entry_id}</guid><description>{escape(summary)}</description>"
+            f"<pubDate>{formatdate(published, usegmt=True)}</pubDate></item>"
+            for entry_id, title, summary, published in self.entries[n]
+        )
+        return (f'<?xml version="1.0" encoding="utf-8"?><rss version="2.0"><channel>'
+                f"<title>Feed {n}</title><link>{self.base}</link>{items}</channel></rss>")
+
+    async def handle(self, request):
+        self.requests += 1
+        n = int(request.match_info["n"])
+        etag = '"%s"' % hashlib.md5(str(self.entries[n][0][0]).encode()).hexdigest()
+        if request.headers.get("If-None-Match") == etag:
+            self.not_modified += 1
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(body=self.render(n).encode(), content_type="application/rss+xml",
+                            headers={"ETag": etag})
+
+
+class FakeBotApi:
+    """Фейковый https://api.telegram.org: записывает sendMessage, умеет 429/403 и задержку."""
+
+    def __init__(self, latency, p429, blocked_users, rng):
+        self.latency = latency
+        self.p429 = p429
+        self.blocked_users = blocked_users
+        self.rng = rng
+        self.sends = []  # (chat_id, text, time.time())
+        self.counts = {"ok": 0, "429": 0, "403": 0}
+        self._message_id = itertools.count(1)
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        form = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method.lower() != "sendmessage":
+            return web.json_response({"ok": True, "result": True})
+
+        chat_id = int(form["chat_id"])
+        if chat_id in self.blocked_users:
+            self.counts["403"] += 1
+            return web.json_response({"ok": False, "error_code": 403,
+                                      "description": "Forbidden: bot was blocked by the user"}, status=403)
+        if self.p429 and self.rng.random() < self.p429:
+            self.counts["429"] += 1
+            return web.json_response({"ok": False, "error_code": 429,
+                                      "description": "Too Many Requests: retry after 1",
+                                      "parameters": {"retry_after": 1}}, status=429)
+        self.counts["ok"] += 1
+        self.sends.append((chat_id, form["text"], time.time()))
+        return web.json_response({"ok": True, "result": {
+            "message_id": next(self._message_id), "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"}, "text": form["text"],
+        }})
+
+
+async def start_site(routes):
+    app = web.Application()
+    app.add_routes(routes)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+def reset_bot_state():
+    # Каждый сценарий — с чистой БД и чистым состоянием модуля
+    newsbot.users_snapshot = newsbot.UserSnapshot()
+    newsbot.seen_store = newsbot.SeenStore()
+    newsbot.delivery = newsbot.DeliveryEngine()
+    newsbot.outbox_sender = newsbot.OutboxSender()
+    newsbot.api_limiter = newsbot.PriorityLimiter(*newsbot.api_budget("all"))
+    newsbot.story_index = newsbot.StoryIndex()
+    newsbot.feed_scheduler = newsbot.FeedScheduler()
+    newsbot.feed_validators.clear()
+    newsbot.stream_order.clear()
+    newsbot.stream_polls.clear()
+
+
+async def seed_users(scenario, feed_names, vocabulary, rng):
+    users = range(1, scenario["users"] + 1)
+    async with newsbot.db_pool.transaction() as db:
+        await db.executemany("INSERT INTO users (user_id) VALUES (?)", [(u,) for u in users])
+        subscriptions = [(u, name) for u in users for name in feed_names if rng.random() < scenario["subscribe_share"]]
+        await db.executemany("INSERT INTO subscriptions (user_id, feed_name) VALUES (?, ?)", subscriptions)
+        keyword_users = [u for u in users if rng.random() < scenario["keyword_share"]]
+        await db.executemany("INSERT INTO user_settings (user_id, filter_mode) VALUES (?, 'keywords')",
+                             [(u,) for u in keyword_users])
+        await db.executemany("INSERT OR IGNORE INTO keywords (user_id, keyword) VALUES (?, ?)",
+                             [(u, rng.choice(vocabulary)) for u in keyword_users
+                              for _ in range(scenario["keywords"])])
+    await newsbot.users_snapshot.load()
+    return len(subscriptions)
+
+
+async def interactive_probe(bot, rate, samples):
+    """Ответы на нажатия кнопок во время рассылки: rate вызовов answerCallbackQuery в секунду."""
+    while True:
+        start = time.perf_counter()
+        await bot.answer_callback_query("probe")
+        samples.append(time.perf_counter() - start)
+        await asyncio.sleep(1 / rate)
+
+
+def percentile(samples, q):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return round(samples[min(len(samples) - 1, int(len(samples) * q))], 3)
+
+
+async def run_scenario(scenario, args):
+    rng = random.Random(args.seed)
+    vocabulary = [f"w{i}" for i in range(args.vocabulary)]
+    rss = RssServer(scenario["feeds"], args.feed_size, vocabulary, rng)
+    blocked = {u for u in range(1, scenario["users"] + 1) if rng.random() < args.blocked}
+    api = FakeBotApi(args.latency, args.p429, blocked, rng)
+
+    rss_runner, rss.base = await start_site([web.get("/feed/{n}.xml", rss.handle)])
+    api_runner, api_base = await start_site([web.post("/bot{token}/{method}", api.handle)])
+    bot = Bot(token=os.environ["BOT_TOKEN"], session=AiohttpSession(api=TelegramAPIServer.from_base(api_base)))
+    bot.session.middleware(newsbot.ApiLaneMiddleware())
+
+    newsbot.SEND_RATE_GLOBAL = args.send_rate
+    queries = {"n": 0}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        newsbot.DB_PATH = os.path.join(tmp, "loadtest.db")
+        newsbot.RSS_FEEDS = {f"Feed {n}": rss.url(n) for n in range(scenario["feeds"])}
+        reset_bot_state()
+        await newsbot.init_db()
+        subscriptions = await seed_users(scenario, list(newsbot.RSS_FEEDS), vocabulary, rng)
+        for conn in newsbot.db_pool._conns:
+            await conn.set_trace_callback(lambda _sql: queries.__setitem__("n", queries["n"] + 1))
+        newsbot.bot = bot
+        newsbot.delivery.start(bot)
+        newsbot.outbox_sender.start()
+
+        # Нулевой цикл: ленты попадают в seen_store, дальше считаются только настоящие новые записи
+        await newsbot.check_news()
+        await newsbot.outbox_sender.drain()
+        api.sends.clear()
+
+        interactive = []
+        probe = asyncio.create_task(interactive_probe(bot, args.interactive_rate, interactive)) \
+            if args.interactive_rate else None
+        cycles = []
+        for _ in range(args.cycles):
+            rss.advance(scenario["entries"])
+            queries["n"] = 0
+            sends_before = len(api.sends)
+            start = time.perf_counter()
+            await newsbot.check_news()
+            cycle_time = time.perf_counter() - start
+            cycle_queries = queries["n"]
+            await newsbot.outbox_sender.drain()
+            cycles.append({
+                "cycle_s": round(cycle_time, 4),
+                "drain_s": round(time.perf_counter() - start, 4),
+                "db_queries": cycle_queries,
+                "sends": len(api.sends) - sends_before,
+            })
+
+        if probe:
+            probe.cancel()
+            await asyncio.gather(probe, return_exceptions=True)
+        await newsbot.delivery.stop()
+        await newsbot.outbox_sender.stop()
+        await newsbot.close_db()
+    await newsbot.close_http_session()
+    await bot.session.close()
+    await api_runner.cleanup()
+    await rss_runner.cleanup()
+
+    latencies = []
+    for _chat_id, text, sent_at in api.sends:
+        match = ENTRY_LINK_RE.search(text)
+        if match:
+            latencies.append(sent_at - rss.published[(int(match.group(1)), int(match.group(2)))])
+    drain = [c["drain_s"] for c in cycles]
+    total_sends = sum(c["sends"] for c in cycles)
+    return {
+        "scenario": scenario,
+        "subscriptions": subscriptions,
+        "cycles": cycles,
+        "cycle_s_mean": round(statistics.fmean(c["cycle_s"] for c in cycles), 4),
+        "db_queries_per_cycle": round(statistics.fmean(c["db_queries"] for c in cycles), 1),
+        "sends_per_s": round(total_sends / sum(drain), 1) if sum(drain) else 0.0,
+        "latency_s": {"p50": percentile(latencies, 0.50), "p90": percentile(latencies, 0.90),
+                      "p99": percentile(latencies, 0.99), "max": percentile(latencies, 1.0)},
+        "interactive_s": {"calls": len(interactive), "p50": percentile(interactive, 0.50),
+                          "p99": percentile(interactive, 0.99), "max": percentile(interactive, 1.0)},
+        "bot_api": api.counts,
+        "delivery": dict(newsbot.delivery.stats),
+        "rss": {"requests": rss.requests, "not_modified": rss.not_modified},
+        # ru_maxrss в Linux — в килобайтах; пик за весь процесс, а не только за сценарий
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+
+async def main(args):
+    grid = itertools.product(args.feeds, args.users, args.keywords, args.entries)
+    results = []
+    for feeds, users, keywords, entries in grid:
+        scenario = {"feeds": feeds, "users": users, "keywords": keywords, "entries": entries,
+                    "keyword_share": args.keyword_share, "subscribe_share": args.subscribe_share}
+        result = await run_scenario(scenario, args)
+        results.append(result)
+        print(f"feeds={feeds} users={users} keywords={keywords} entries={entries}: "
+              f"cycle {result['cycle_s_mean']} s, {result['sends_per_s']} sends/s, "
+              f"p99 latency {result['latency_s']['p99']} s", file=sys.stderr)
+
+    report = {"generated_at": time.time(), "params": {k: v for k, v in vars(args).items() if k != "output"},
+              "results": results}
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        Path(args.output).write_text(text, encoding="utf-8")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--feeds", type=int_list, default=[3], help="число лент (можно списком: 3,10)")
+    parser.add_argument("--users", type=int_list, default=[200])
+    parser.add_argument("--keywords", type=int_list, default=[5], help="слов на пользователя в режиме 'keywords'")
+    parser.add_argument("--entries", type=int_list, default=[2], help="новых записей в каждой ленте за цикл")
+    parser.add_argument("--cycles", type=int, default=3)
+    parser.add_argument("--feed-size", type=int, default=50, help="записей в документе ленты")
+    parser.add_argument("--keyword-share", type=float, default=0.5, help="доля пользователей в режиме 'keywords'")
+    parser.add_argument("--subscribe-share", type=float, default=0.7, help="вероятность подписки на каждую ленту")
+    parser.add_argument("--vocabulary", type=int, default=500, help="размер словаря заголовков и слов")
+    parser.add_argument("--send-rate", type=float, default=500,
+                        help="общий лимит отправки, сообщений/с (у настоящего Telegram ~30)")
+    parser.add_argument("--interactive-rate", type=float, default=0.0,
+                        help="ответов на кнопки в секунду во время рассылки (задержка — в interactive_s)")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа Bot API, сек.")
+    parser.add_argument("--p429", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--blocked", type=float, default=0.0, help="доля пользователей, заблокировавших бота")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="куда записать JSON (по умолчанию stdout)")
+    asyncio.run(main(parser.parse_args()))
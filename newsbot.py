@@ -1,20 +1,57 @@
 import asyncio
+import bisect
+from array import array
+import calendar
+import hashlib
+import heapq
+import html
+import ipaddress
+import json
+import math
+import multiprocessing
 import os
-
+import re
+import signal
+import socket
+import statistics
+import sys
+import time
+import unicodedata
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from email.utils import parsedate_to_datetime
+from functools import partial
+from typing import NamedTuple
+from urllib.parse import unquote_plus, urljoin, urlsplit, urlunsplit
+from xml.etree import ElementTree
+
+import aiohttp
+from aiohttp import web
 import aiosqlite
+import yarl
 import feedparser
 from aiogram import Bot, Dispatcher, F, types
+from aiogram.exceptions import (TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter,
+                                TelegramServerError)
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
-from datetime import datetime
+from datetime import datetime, timezone
 import random
 
 # Добавьте эти импорты в начало файла к остальным from aiogram...
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
 from dotenv import load_dotenv
 
 # Создаем класс для отслеживания состояния "Ожидание ключевого слова"
-class Form(StatesGroup): waiting_for_keyword = State()
+class Form(StatesGroup):
+    waiting_for_keyword = State()
+    waiting_for_feed_url = State()  # пользователь присылает ссылку на свою RSS-ленту
 
 # --------- Настройки (подставьте ваш токен) ---------
 load_dotenv()
@@ -23,10 +60,115 @@ if not BOT_TOKEN: exit("Error: BOT_TOKEN not found in environment variables!")
 
 CHECK_INTERVAL = 10
 DB_PATH = "news_bot.db"
+DB_POOL_SIZE = 4          # долгоживущих соединений с SQLite
+
+# Загрузка лент
+FETCH_TIMEOUT = 15        # сек. на одну ленту (вместе с чтением тела)
+FETCH_CONCURRENCY = 20    # сколько лент качаем одновременно
+USER_AGENT = "NewsAggregatorBot/1.0 (+https://github.com/msmsat/News-Aggregator-Bot)"
+FETCH_MAX_BYTES = 10 * 1024 * 1024  # больше — это не лента (ленты добавляют и пользователи)
+FETCH_MAX_REDIRECTS = 5   # для лент пользователей: каждый переход проверяем заново
+# Потоковый разбор: читать ленту, пока не встретятся подряд столько уже виденных записей
+STREAM_PARSE = os.getenv("STREAM_PARSE", "1") == "1"
+STREAM_STOP_AFTER_SEEN = 3     # >1 — переживаем перестановки соседних записей (Reddit)
+STREAM_FULL_EVERY = 30         # каждый N-й опрос всё равно читаем целиком
+STREAM_CHUNK_SIZE = 16 * 1024
+STREAM_INLINE_ENTRIES = 20     # больше записей подряд без раннего выхода — дочитываем и разбираем вне event loop
+# Процессов для разбора XML (0 — разбирать в потоке внутри основного процесса)
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", min(4, os.cpu_count() or 1)))
+
+# Планировщик опроса: интервал для каждой ленты свой, в этих пределах (сек.)
+POLL_DEFAULT_INTERVAL = CHECK_INTERVAL
+POLL_MIN_INTERVAL = 5
+POLL_MAX_INTERVAL = 15 * 60
+POLL_BACKOFF_MAX = 60 * 60     # потолок отсрочки для падающей ленты
+POLL_LEARN_ENTRIES = 20        # по скольким последним датам публикации учим интервал
+POLL_GAP_FRACTION = 0.25       # интервал опроса = такая доля от типичного промежутка между записями
+FETCH_BUDGET_PER_SEC = 5       # не больше стольких запросов к лентам в секунду на всех
+
+# Рассылка (лимиты Telegram: ~30 сообщений/с на бота, ~1/с в один чат)
+SEND_RATE_GLOBAL = 30
+SEND_RATE_PER_CHAT = 1
+SEND_BURST_PER_CHAT = 3   # короткая пачка в один чат допустима
+SEND_WORKERS = 32
+SEND_QUEUE_SIZE = 100_000
+SEND_MAX_RETRIES = 5
+SEND_FLOOD_CHATS = 3      # 429 по стольким чатам за секунду = пауза всей рассылки
+SEND_INTERACTIVE_SHARE = 0.2  # доля общего лимита, которую рассылка оставляет ответам на кнопки и команды
+
+# Приём апдейтов: polling (по умолчанию) или webhook — Telegram сам присылает их на WEBHOOK_URL.
+# В режиме webhook можно поднять несколько копий бота за балансировщиком: FSM и снимок пользователей
+# общие через SQLite, а опрос лент и дайджесты (RUN_MONITOR=1) должны крутиться ровно в одной копии.
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")          # публичный https://host/path
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")    # Telegram пришлёт его в X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_CONCURRENCY = 64       # апдейтов в обработке одновременно; остальные Telegram придержит у себя
+RUN_MONITOR = os.getenv("RUN_MONITOR", "1") == "1"
+SHUTDOWN_TIMEOUT = 30          # сколько ждать начатые обработчики и циклы проверки при остановке
+STATE_REFRESH_INTERVAL = 10    # как часто подтягивать ленты и пользователей, изменённых другими копиями
+if BOT_MODE == "webhook" and not (WEBHOOK_URL and WEBHOOK_SECRET):
+    exit("Error: BOT_MODE=webhook needs WEBHOOK_URL and WEBHOOK_SECRET!")
+
+# Outbox: задания рассылки лежат в SQLite — переживают перезапуск, их могут разбирать несколько процессов.
+# BOT_ROLE: all — всё в одном процессе; bot — апдейты и опрос лент без рассылки; sender — только рассылка
+BOT_ROLE = os.getenv("BOT_ROLE", "all")
+OUTBOX_BATCH = 500             # заданий за один захват
+OUTBOX_LEASE = 300             # сек.; не подтверждённые за это время задания заберёт другой отправитель
+OUTBOX_POLL_INTERVAL = 1.0     # как часто заглядывать в outbox, если никто не разбудил
+OUTBOX_MAX_ATTEMPTS = 5        # после стольких неудачных захватов задание выбрасывается
+OUTBOX_RETRY_DELAY = 60
+# Лимит Telegram — на токен, а не на процесс: SEND_RATE_GLOBAL делится между всеми, кто рассылает
+# (BOT_ROLE=all и sender). Больше отправителей не значит быстрее — только переживём падение одного из них.
+SENDER_PROCESSES = max(1, int(os.getenv("SENDER_PROCESSES", "1")))
+UPDATE_PROCESSES = max(1, int(os.getenv("UPDATE_PROCESSES", "1")))  # сколько копий принимают апдейты (all и bot)
+
+# Режим «Дайджест»: новости копятся и уходят одним сообщением раз в DIGEST_INTERVAL или по DIGEST_MAX_ITEMS штук
+DIGEST_INTERVAL = 30 * 60
+DIGEST_MAX_ITEMS = 20
+DIGEST_CHECK_INTERVAL = 30     # как часто проверять, чьи дайджесты пора отправить
+TELEGRAM_MAX_MESSAGE = 4096    # символов в одном сообщении
+DIGEST_TITLE_MAX = 300
+DIGEST_LINK_MAX = 1000         # вместе с заголовком и именем ленты новость всегда меньше сообщения
+DIGEST_HEADER_MAX = 200
+
+# Виденные записи: сколько помнить на ленту и как долго после исчезновения из неё
+SEEN_MAX_PER_FEED = 2000
+SEEN_TTL = 7 * 24 * 3600
+
+# Метрики: GET /metrics в формате Prometheus (0 — не поднимать) и JSON-строка на каждый цикл
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_JSON_LOG = os.getenv("METRICS_JSON_LOG", "")  # путь к файлу .jsonl; пусто — не писать
+
+# Похожие новости: одну историю из разных лент (или перезалитую с правкой заголовка) шлём пользователю один раз
+DEDUP = os.getenv("DEDUP", "1") == "1"
+DEDUP_WINDOW = 24 * 3600       # сколько помнить разосланные истории
+DEDUP_SIMILARITY = 0.7         # сходство наборов слов (оценка Жаккара по MinHash), с которого это одна история
+DEDUP_MIN_TOKENS = 6           # короче — сравниваем только по ссылке: у коротких заголовков сходство шумное
+DEDUP_MAX_STORIES = 200_000
+DEDUP_MAX_MATCHES = 5          # по скольким последним похожим историям считаем, кто их уже получил
+DEDUP_MAX_RECIPIENTS = 10_000_000  # всего запомненных получателей (по 8 байт); сверх — старые истории забываются
+
+# Архив записей (SQLite FTS5): поиск /search и подбор свежих новостей под только что добавленное слово
+ARCHIVE_RETENTION = 14 * 24 * 3600
+ARCHIVE_SUMMARY_MAX = 500      # символов описания в индексе
+ARCHIVE_PRUNE_BATCH = 10_000   # строк за одну транзакцию при чистке
+KEYWORD_BACKFILL_HOURS = 24
+SEARCH_RESULTS = 10
+
+# Ключевые слова: 1 — совпадение только целым словом ("рост" не сработает на "простой")
+KEYWORD_WHOLE_WORDS = os.getenv("KEYWORD_WHOLE_WORDS", "0") == "1"
+# Ленты от пользователей: не больше стольких на человека; меню подписок — по стольким на страницу
+FEEDS_MAX_PER_USER = 20
+FEEDS_PAGE_SIZE = 8
+FEED_NAME_MAX = 48
 # Источники (выберите один)
 # 1. Американский (CNN Top Stories)
 # Словарь источников: "Название": "Ссылка"
 # СУПЕР-БЫСТРЫЕ ИСТОЧНИКИ
+# Встроенные ленты: при старте заносятся в таблицу feeds, дальше список лент живёт в БД (feed_registry)
 RSS_FEEDS = {
     # Reddit (r/news /new) — посты выходят каждые 1-2 минуты
     "Reddit News 🌎": "https://www.reddit.com/r/news/new/.rss",
@@ -40,12 +182,216 @@ RSS_FEEDS = {
 # -----------------------------
 
 bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
+
+
+# --- Метрики ---
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LAG_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 4 * 3600)
+
+METRIC_HELP = {
+    "newsbot_stage_seconds": ("histogram", "Время этапов обработки: fetch, parse, detect, recipients, match, dedup, enqueue, send"),
+    "newsbot_delivery_lag_seconds": ("histogram", "От публикации записи в ленте до доставки пользователю"),
+    "newsbot_fetch_total": ("counter", "Загрузки лент по результату (пользовательские ленты — под feed=user)"),
+    "newsbot_new_entries_total": ("counter", "Новые записи по лентам"),
+    "newsbot_enqueued_total": ("counter", "Сообщения, поставленные в очередь рассылки"),
+    "newsbot_dedup_suppressed_total": ("counter", "Сообщения, не отправленные как повтор уже разосланной истории"),
+    "newsbot_sends_total": ("counter", "Попытки отправки по результату"),
+    "newsbot_api_calls_total": ("counter", "Вызовы Bot API по полосам: interactive, broadcast, unmetered"),
+    "newsbot_api_wait_seconds": ("histogram", "Ожидание общего лимита Bot API по полосам"),
+    "newsbot_digests_total": ("counter", "Сообщения-дайджесты, поставленные в очередь рассылки"),
+    "newsbot_cycles_total": ("counter", "Циклы check_news()"),
+    "newsbot_stream_parse_total": ("counter", "Потоковый разбор: early_exit, full (дочитан до конца), handoff (почти всё новое — в пул), fallback (на feedparser)"),
+    "newsbot_send_queue_depth": ("gauge", "Сообщений в очереди доставки этого процесса (не больше пачки outbox)"),
+    "newsbot_outbox_pending": ("gauge", "Заданий outbox, готовых к отправке, — общий хвост всех отправителей"),
+    "newsbot_active_chats": ("gauge", "Чатов с активным лимитом отправки"),
+    "newsbot_feeds": ("gauge", "Лент в расписании"),
+}
+
+# Итоги текущего цикла check_news(); задачи, созданные внутри цикла, видят тот же словарь
+current_cycle = ContextVar("current_cycle", default=None)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Счётчики, гистограммы и датчики в памяти процесса с выводом в формате Prometheus.
+
+    Запись метрики — несколько операций со словарём, без блокировок и ввода-вывода,
+    поэтому инструментирование можно держать включённым всегда.
+    """
+
+    def __init__(self):
+        self.counters = {}    # (name, labels) -> число
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.gauges = {}      # name -> функция без аргументов
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = Histogram(buckets)
+        hist.observe(value)
+
+    def gauge(self, name, func):
+        self.gauges[name] = func
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe("newsbot_stage_seconds", elapsed, stage=stage, **labels)
+            cycle = current_cycle.get()
+            if cycle is not None:
+                cycle["stages"][stage] = cycle["stages"].get(stage, 0.0) + elapsed
+
+    def render(self):
+        """Текст для GET /metrics (Prometheus exposition format 0.0.4)."""
+        lines = []
+        described = set()
+
+        def describe(name):
+            if name not in described:
+                described.add(name)
+                kind, help_text = METRIC_HELP.get(name, ("untyped", name))
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(self.counters.items()):
+            describe(name)
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), hist in sorted(self.histograms.items(), key=lambda item: item[0]):
+            describe(name)
+            cumulative = 0
+            for bound, count in zip(hist.buckets, hist.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {hist.count}")
+            lines.append(f"{name}_sum{format_labels(labels)} {hist.sum}")
+            lines.append(f"{name}_count{format_labels(labels)} {hist.count}")
+        for name, func in sorted(self.gauges.items()):
+            describe(name)
+            lines.append(f"{name} {func()}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+metrics = Metrics()
+
+
+async def start_metrics_server():
+    """GET /metrics на METRICS_HOST:METRICS_PORT. Возвращает runner для остановки или None."""
+    if not METRICS_PORT:
+        return None
+
+    async def handle_metrics(request):
+        return web.Response(text=metrics.render(),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    print(f"📈 Метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+
+def write_cycle_log(cycle):
+    # Одна JSON-строка на цикл — удобно для jq и сборщиков логов
+    with open(METRICS_JSON_LOG, "a", encoding="utf-8") as log:
+        log.write(json.dumps(cycle, ensure_ascii=False) + "\n")
 
 
 # --- Работа с БД ---
+class DBPool:
+    """Небольшой пул долгоживущих соединений aiosqlite (WAL, synchronous=NORMAL)."""
+
+    def __init__(self, path, size=DB_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._conns = []
+        self._free = asyncio.Queue()
+        # У SQLite один писатель — сериализуем записи сами, чтобы не ловить SQLITE_BUSY
+        self._write_lock = asyncio.Lock()
+
+    async def open(self):
+        for _ in range(self.size):
+            # isolation_level=None: чтения идут без транзакций, записи — только через transaction().
+            # cached_statements: sqlite3 кэширует подготовленные запросы на каждом соединении
+            conn = await aiosqlite.connect(self.path, isolation_level=None, cached_statements=256)
+            await conn.execute("PRAGMA journal_mode=WAL")
+            await conn.execute("PRAGMA synchronous=NORMAL")
+            await conn.execute("PRAGMA busy_timeout=5000")
+            self._conns.append(conn)
+            self._free.put_nowait(conn)
+
+    async def close(self):
+        for conn in self._conns:
+            await conn.close()
+        self._conns.clear()
+        self._free = asyncio.Queue()
+
+    @asynccontextmanager
+    async def connection(self):
+        conn = await self._free.get()
+        try:
+            yield conn
+        finally:
+            self._free.put_nowait(conn)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Одна транзакция на весь блок: либо всё записалось, либо ничего."""
+        async with self._write_lock, self.connection() as conn:
+            await conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                await conn.rollback()
+                raise
+            else:
+                await conn.commit()
+
+
+db_pool = None
+
+
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
+    global db_pool
+    db_pool = DBPool(DB_PATH)
+    await db_pool.open()
+    async with db_pool.transaction() as db:
         await db.execute("CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY)")
         await db.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)")
         await db.execute(
@@ -53,189 +399,2352 @@ async def init_db():
         await db.execute("CREATE TABLE IF NOT EXISTS keywords (user_id INTEGER, keyword TEXT)")
 
         # НОВАЯ ТАБЛИЦА: Настройки пользователя
-        # filter_mode может быть 'all' (все новости) или 'keywords' (только слова)
+        # filter_mode может быть 'all' (все новости), 'keywords' (только слова) или 'digest' (всё, но пачкой)
         await db.execute("CREATE TABLE IF NOT EXISTS user_settings (user_id INTEGER PRIMARY KEY, filter_mode TEXT)")
-        await db.commit()
+
+        # Индексы: toggle_subscription ищет по паре (feed_name, user_id)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_feed ON subscriptions (feed_name, user_id)")
+        # Старые базы могли накопить дубли слов — чистим перед уникальным индексом
+        await db.execute("""
+            DELETE FROM keywords WHERE rowid NOT IN (
+                SELECT MIN(rowid) FROM keywords GROUP BY user_id, keyword
+            )
+        """)
+        await db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_keywords_user_keyword ON keywords (user_id, keyword)")
+
+        # Виденные записи лент: 64-битные хеши guid/ссылок
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS seen_entries (
+                feed_name TEXT, entry_key INTEGER, seen_at REAL,
+                PRIMARY KEY (feed_name, entry_key)
+            ) WITHOUT ROWID
+        """)
+
+        # Архив записей: сами записи + полнотекстовый индекс по нормализованному тексту (rowid = archive.id)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS archive (
+                id INTEGER PRIMARY KEY, feed_name TEXT, title TEXT, link TEXT, published REAL, fetched_at REAL NOT NULL
+            )
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_archive_fetched ON archive (fetched_at)")
+        await db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS archive_fts USING fts5(text, tokenize='unicode61')")
+
+        # Журнал изменений пользователей: по нему копия с RUN_MONITOR=1 обновляет свой снимок
+        await db.execute("CREATE TABLE IF NOT EXISTS user_changes (id INTEGER PRIMARY KEY, user_id INTEGER, created_at REAL)")
+        # Состояния FSM для режима webhook — апдейт одного пользователя может прийти в любую копию
+        await db.execute("CREATE TABLE IF NOT EXISTS fsm_states (key TEXT PRIMARY KEY, state TEXT, data TEXT)")
+
+        # Реестр лент: встроенные из RSS_FEEDS и добавленные пользователями; url — канонический
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS feeds (
+                id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, url TEXT NOT NULL UNIQUE,
+                added_by INTEGER, created_at REAL
+            )
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_feeds_added_by ON feeds (added_by)")
+        # Встроенные ленты сверяем с RSS_FEEDS по имени: поменянная в коде ссылка должна дойти до БД
+        for name, url in RSS_FEEDS.items():
+            try:
+                async with db.execute("""
+                    INSERT INTO feeds (name, url, created_at) VALUES (?, ?, ?)
+                    ON CONFLICT(name) DO UPDATE SET url = excluded.url WHERE added_by IS NULL
+                    RETURNING id
+                """, (name, canonical_url(url), time.time())) as cursor:
+                    seeded = await cursor.fetchone() is not None
+            except aiosqlite.IntegrityError:
+                print(f"⚠️ RSS_FEEDS: {url} уже заведена в БД под другим именем, «{name}» пропущена")
+                continue
+            if not seeded:
+                print(f"⚠️ RSS_FEEDS: имя «{name}» занято лентой пользователя, встроенная пропущена")
+
+        # Outbox: текст сообщения хранится один раз, задания — по одному на получателя
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS outbox_messages (
+                id INTEGER PRIMARY KEY, feed_name TEXT, text TEXT, published REAL, created_at REAL
+            )
+        """)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY, message_id INTEGER NOT NULL, user_id INTEGER NOT NULL,
+                claimed_by TEXT, claimed_until REAL NOT NULL DEFAULT 0, attempts INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_outbox_claim ON outbox (claimed_until, id)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_outbox_message ON outbox (message_id)")
+        # Накопленные новости пользователей в режиме 'digest'
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS digest_items (
+                id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, feed_name TEXT, title TEXT, link TEXT,
+                created_at REAL NOT NULL
+            )
+        """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_digest_user ON digest_items (user_id, created_at)")
+
+        # active = 0 — пользователь заблокировал бота, рассылка его пропускает
+        async with db.execute("PRAGMA table_info(users)") as cursor:
+            user_columns = {row[1] for row in await cursor.fetchall()}
+        if "active" not in user_columns:
+            await db.execute("ALTER TABLE users ADD COLUMN active INTEGER NOT NULL DEFAULT 1")
+
+    await users_snapshot.load()
+    await seen_store.load()
+    await feed_registry.load()
+
+
+async def close_db():
+    if db_pool is not None:
+        await db_pool.close()
+
+async def log_user_change(db, user_id):
+    """Отмечает в журнале, что у пользователя что-то поменялось; вызывается внутри транзакции."""
+    await db.execute("INSERT INTO user_changes (user_id, created_at) VALUES (?, ?)", (user_id, time.time()))
+
+
+class SQLiteStorage(BaseStorage):
+    """Хранилище FSM в SQLite: состояние «жду слово» переживает перезапуск и видно всем копиям бота."""
+
+    @staticmethod
+    def _key(key):
+        return (f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id}:"
+                f"{key.business_connection_id}:{key.destiny}")
+
+    async def set_state(self, key, state=None):
+        state = state.state if isinstance(state, State) else state
+        async with db_pool.transaction() as db:
+            await db.execute("""
+                INSERT INTO fsm_states (key, state, data) VALUES (?, ?, '{}')
+                ON CONFLICT(key) DO UPDATE SET state = excluded.state
+            """, (self._key(key), state))
+
+    async def get_state(self, key):
+        async with db_pool.connection() as db:
+            async with db.execute("SELECT state FROM fsm_states WHERE key = ?", (self._key(key),)) as cursor:
+                row = await cursor.fetchone()
+        return row[0] if row else None
+
+    async def set_data(self, key, data):
+        async with db_pool.transaction() as db:
+            await db.execute("""
+                INSERT INTO fsm_states (key, data) VALUES (?, ?)
+                ON CONFLICT(key) DO UPDATE SET data = excluded.data
+            """, (self._key(key), json.dumps(dict(data), ensure_ascii=False)))
+
+    async def get_data(self, key):
+        async with db_pool.connection() as db:
+            async with db.execute("SELECT data FROM fsm_states WHERE key = ?", (self._key(key),)) as cursor:
+                row = await cursor.fetchone()
+        return json.loads(row[0]) if row and row[0] else {}
+
+    async def close(self):
+        pass
+
+
+# Апдейты разных копий бота сходятся в одной базе — FSM тоже храним там
+dp = Dispatcher(storage=SQLiteStorage() if BOT_MODE == "webhook" else None)
 
 # --- НОВЫЕ ФУНКЦИИ ДЛЯ НАСТРОЕК ---
 async def set_filter_mode(user_id, mode):
-    """mode: 'all' или 'keywords'"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    """mode: 'all', 'keywords' или 'digest'"""
+    async with db_pool.transaction() as db:
         await db.execute("INSERT OR REPLACE INTO user_settings (user_id, filter_mode) VALUES (?, ?)", (user_id, mode))
-        await db.commit()
+        await log_user_change(db, user_id)
+    users_snapshot.set_mode(user_id, mode)
 
 async def get_filter_mode(user_id):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.connection() as db:
         async with db.execute("SELECT filter_mode FROM user_settings WHERE user_id = ?", (user_id,)) as cursor:
             row = await cursor.fetchone()
             # По умолчанию возвращаем 'all' (все новости), если настройки нет
             return row[0] if row else 'all'
 
 async def add_user(user_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
-        await db.commit()
+    async with db_pool.transaction() as db:
+        # Повторный /start снова включает рассылку, если пользователь разблокировал бота
+        await db.execute("INSERT INTO users (user_id) VALUES (?) ON CONFLICT(user_id) DO UPDATE SET active = 1",
+                         (user_id,))
+        await log_user_change(db, user_id)
+    users_snapshot.inactive.discard(user_id)
+
+async def deactivate_user(user_id):
+    async with db_pool.transaction() as db:
+        await db.execute("UPDATE users SET active = 0 WHERE user_id = ?", (user_id,))
+        await log_user_change(db, user_id)
+    users_snapshot.inactive.add(user_id)
 
 async def get_user_subscriptions(user_id):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.connection() as db:
         async with db.execute("SELECT feed_name FROM subscriptions WHERE user_id = ?", (user_id,)) as cursor:
             rows = await cursor.fetchall()
             return [row[0] for row in rows]
 
 async def toggle_subscription(user_id, feed_name):
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT 1 FROM subscriptions WHERE user_id = ? AND feed_name = ?", (user_id, feed_name)) as cursor:
-            exists = await cursor.fetchone()
-        if exists:
-            await db.execute("DELETE FROM subscriptions WHERE user_id = ? AND feed_name = ?", (user_id, feed_name))
-            await db.commit()
-            return False
-        else:
+    async with db_pool.transaction() as db:
+        cursor = await db.execute("DELETE FROM subscriptions WHERE user_id = ? AND feed_name = ?", (user_id, feed_name))
+        subscribed = not cursor.rowcount
+        if subscribed:
             await db.execute("INSERT INTO subscriptions (user_id, feed_name) VALUES (?, ?)", (user_id, feed_name))
-            await db.commit()
-            return True
-
-async def get_users_for_feed(feed_name):
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT user_id FROM subscriptions WHERE feed_name = ?", (feed_name,)) as cursor:
-            rows = await cursor.fetchall()
-            return [row[0] for row in rows]
+        await log_user_change(db, user_id)
+    # Снимок трогаем только после коммита
+    if subscribed:
+        users_snapshot.subscribe(user_id, feed_name)
+    else:
+        users_snapshot.unsubscribe(user_id, feed_name)
+    return subscribed
 
 # --- НОВЫЕ ФУНКЦИИ ДЛЯ СЛОВ ---
 async def add_keyword(user_id, keyword):
     clean_word = keyword.lower().strip()  # Убираем пробелы и делаем маленькими буквами
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Проверяем, есть ли слово
-        async with db.execute("SELECT 1 FROM keywords WHERE user_id = ? AND keyword = ?",
-                              (user_id, clean_word)) as cursor:
-            exists = await cursor.fetchone()
-
-        # Если нет — добавляем
-        if not exists:
-            await db.execute("INSERT INTO keywords (user_id, keyword) VALUES (?, ?)", (user_id, clean_word))
-            await db.commit()
-            return True  # Успешно добавлено
-
-        return False  # Такое слово уже есть
+    async with db_pool.transaction() as db:
+        # Уникальный индекс сам отсекает повторы
+        cursor = await db.execute("INSERT OR IGNORE INTO keywords (user_id, keyword) VALUES (?, ?)", (user_id, clean_word))
+        added = cursor.rowcount == 1
+        await log_user_change(db, user_id)
+    if added:
+        users_snapshot.add_keyword(user_id, clean_word)
+    return added  # True — добавлено, False — такое слово уже есть
 
 async def get_user_keywords(user_id):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.connection() as db:
         async with db.execute("SELECT keyword FROM keywords WHERE user_id = ?", (user_id,)) as cursor:
             rows = await cursor.fetchall()
             return [row[0] for row in rows]
 
 async def clear_keywords(user_id):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.transaction() as db:
         # Удаляем ВСЕ записи для этого пользователя из таблицы keywords
         await db.execute("DELETE FROM keywords WHERE user_id = ?", (user_id,))
-        await db.commit()
+        await log_user_change(db, user_id)
+    users_snapshot.clear_keywords(user_id)
 
 # (Старые функции настроек оставляем как были)
-async def get_last_link(feed_name):
-    key = f"last_link_{feed_name}"
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT value FROM settings WHERE key = ?", (key,)) as cursor:
-            row = await cursor.fetchone()
-            return row[0] if row else None
-
-async def set_last_link(feed_name, link):
-    key = f"last_link_{feed_name}"
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            INSERT INTO settings (key, value) VALUES (?, ?)
-            ON CONFLICT(key) DO UPDATE SET value = excluded.value
-        """, (key, link))
-        await db.commit()
+async def get_last_links(feed_names):
+    """Пакетное чтение курсоров: {feed_name: last_link или None}."""
+    keys = {f"last_link_{name}": name for name in feed_names}
+    result = {name: None for name in keys.values()}
+    if not keys:
+        return result
+    placeholders = ",".join("?" * len(keys))
+    async with db_pool.connection() as db:
+        async with db.execute(f"SELECT key, value FROM settings WHERE key IN ({placeholders})", list(keys)) as cursor:
+            for key, value in await cursor.fetchall():
+                result[keys[key]] = value
+    return result
 
 async def delete_specific_keyword(user_id, keyword):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_pool.transaction() as db:
         await db.execute("DELETE FROM keywords WHERE user_id = ? AND keyword = ?", (user_id, keyword))
-        await db.commit()
-
-
-# --- Логика проверки новостей (С ФИЛЬТРАЦИЕЙ) ---
-async def check_news():
-    print(f"[{datetime.now().time()}] --- Проверка быстрых источников ---")
+        await log_user_change(db, user_id)
+    users_snapshot.remove_keyword(user_id, keyword)
+
+
+# --- Поиск ключевых слов (Ахо-Корасик по словам всех пользователей) ---
+KEYWORD_DELTA_LIMIT = 1024  # сколько новых слов держим в малом автомате до слияния с основным
+
+
+def normalize_text(text):
+    """Приводит текст к виду для сравнения: NFKC, casefold, 'ё' -> 'е'."""
+    return unicodedata.normalize("NFKC", text).casefold().replace("ё", "е")
+
+
+class AhoCorasick:
+    """Автомат Ахо-Корасик над набором строк. Суффиксные ссылки строятся лениво."""
+
+    def __init__(self, patterns=()):
+        self._goto = [{}]        # узел -> {символ: узел}
+        self._fail = [0]
+        self._terminal = [None]  # слово, которое заканчивается ровно в этом узле
+        self._out = [()]         # все слова, заканчивающиеся в узле (с учётом суффиксных ссылок)
+        self._count = 0
+        self._built = True
+        for pattern in patterns:
+            self.add(pattern)
+
+    def __len__(self):
+        return self._count
+
+    def add(self, pattern):
+        node = 0
+        for ch in pattern:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._terminal.append(None)
+                self._out.append(())
+            node = nxt
+        if self._terminal[node] is None:
+            self._terminal[node] = pattern
+            self._count += 1
+            self._built = False
+
+    def _build(self):
+        # BFS по бору: суффиксная ссылка и список выходов для каждого узла
+        goto, fail, out, terminal = self._goto, self._fail, self._out, self._terminal
+        queue = deque()
+        for child in goto[0].values():
+            fail[child] = 0
+            out[child] = (terminal[child],) if terminal[child] else ()
+            queue.append(child)
+        while queue:
+            node = queue.popleft()
+            for ch, child in goto[node].items():
+                f = fail[node]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[child] = goto[f].get(ch, 0)
+                own = (terminal[child],) if terminal[child] else ()
+                out[child] = own + out[fail[child]]
+                queue.append(child)
+        self._built = True
+
+    def find(self, text):
+        """Генератор пар (слово, позиция конца) для всех вхождений в text."""
+        if not self._built:
+            self._build()
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                for pattern in out[node]:
+                    yield pattern, i + 1
+
+
+def build_automaton(patterns):
+    """Полностью собранный автомат (вместе с суффиксными ссылками) — можно звать в потоке."""
+    automaton = AhoCorasick(patterns)
+    automaton._build()
+    return automaton
+
+
+def release_automaton(automaton):
+    # Освобождаем кусками: разом сотни тысяч узлов — это сотни миллисекунд без отпускания GIL
+    for nodes in (automaton._goto, automaton._out, automaton._fail, automaton._terminal):
+        while nodes:
+            del nodes[-10_000:]
+
+
+class KeywordMatcher:
+    """Все ключевые слова всех пользователей в одном автомате.
+
+    Текст новости просматривается один раз, на выходе — множество user_id,
+    у которых сработало хотя бы одно слово. Новые слова попадают в малый
+    дельта-автомат (его пересборка дешёвая) и время от времени вливаются в основной —
+    в работающем боте эта пересборка идёт в потоке, не останавливая event loop.
+    Удаление — O(1), мёртвые слова вычищаются при следующем слиянии.
+    """
+
+    def __init__(self, whole_words=False):
+        self.whole_words = whole_words
+        self._users = {}        # слово -> {user_id: сколько его слов дают это слово после нормализации}
+        self._indexed = set()   # слова, которые есть в автоматах (в том числе уже без пользователей)
+        self._main = AhoCorasick()
+        self._delta = AhoCorasick()
+        self._merging = None    # задача фоновой пересборки
+
+    def _merge(self):
+        if self._merging is not None:
+            return
+        patterns = list(self._users)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._swap(build_automaton(patterns), set(patterns))
+            return
+        self._merging = loop.create_task(self._merge_in_thread(patterns))
 
-    for feed_name, feed_url in RSS_FEEDS.items():
+    async def _merge_in_thread(self, patterns):
+        try:
+            main = await asyncio.to_thread(build_automaton, patterns)
+            merged = await asyncio.to_thread(set, patterns)
+            old = self._swap(main, merged)
+            await asyncio.to_thread(release_automaton, old)
+        finally:
+            self._merging = None
+
+    def _swap(self, main, merged):
+        """Ставит новый основной автомат (merged — его слова). Возвращает старый."""
+        # Слова, добавленные, пока собирался основной автомат, остаются в новой дельте
+        added = [pattern for pattern in self._users if pattern not in merged]
+        old, self._main = self._main, main
+        self._delta = AhoCorasick(added)
+        merged.update(added)
+        self._indexed = merged
+        return old
+
+    def add(self, user_id, keyword):
+        pattern = normalize_text(keyword.strip())
+        if not pattern:
+            return
+        users = self._users.get(pattern)
+        if users is None:
+            users = self._users[pattern] = {}
+            if pattern not in self._indexed:
+                # Слово уже есть в автомате (удалили и вернули, например refresh()) — просто оживает
+                self._indexed.add(pattern)
+                self._delta.add(pattern)
+                if len(self._delta) > KEYWORD_DELTA_LIMIT:
+                    self._merge()
+        users[user_id] = users.get(user_id, 0) + 1
+
+    def add_many(self, pairs):
+        """Массовая загрузка (user_id, keyword) с одной сборкой автомата — сразу, в вызывающем потоке."""
+        for user_id, keyword in pairs:
+            pattern = normalize_text(keyword.strip())
+            if pattern:
+                users = self._users.setdefault(pattern, {})
+                users[user_id] = users.get(user_id, 0) + 1
+        patterns = list(self._users)
+        self._swap(build_automaton(patterns), set(patterns))
+
+    def remove(self, user_id, keyword):
+        pattern = normalize_text(keyword.strip())
+        users = self._users.get(pattern)
+        if not users or user_id not in users:
+            return
+        # У пользователя могут быть «ёлка» и «елка» — одно слово после нормализации, удаляем по одному
+        users[user_id] -= 1
+        if users[user_id]:
+            return
+        del users[user_id]
+        if not users:
+            # Слово остаётся в автомате и просто не даёт совпадений; когда мусора много — пересобираем
+            del self._users[pattern]
+            dead = len(self._indexed) - len(self._users)
+            if dead > 1000 and dead > len(self._users):
+                self._merge()
+
+    def match(self, text):
+        """Возвращает множество user_id, чьи слова встречаются в text."""
+        text = normalize_text(text)
+        found = set()
+        for automaton in (self._main, self._delta):
+            if not len(automaton):
+                continue
+            for pattern, end in automaton.find(text):
+                if self.whole_words and not self._is_whole_word(text, end - len(pattern), end):
+                    continue
+                found.add(pattern)
+        users = set()
+        for pattern in found:
+            users.update(self._users.get(pattern, ()))
+        return users
+
+    @staticmethod
+    def _is_whole_word(text, start, end):
+        return (start == 0 or not text[start - 1].isalnum()) and (end == len(text) or not text[end].isalnum())
+
+
+# --- Снимок подписчиков в памяти ---
+class UserSnapshot:
+    """Подписки, режимы и слова всех пользователей в памяти процесса.
+
+    Загружается один раз в init_db(), дальше его обновляют функции записи выше,
+    поэтому рассылка не делает ни одного запроса к БД на получателя.
+    """
+
+    def __init__(self):
+        self.subscribers = {}  # feed_name -> set(user_id)
+        self.modes = {}        # user_id -> filter_mode; 'all' (по умолчанию) не храним
+        self.keywords = {}     # user_id -> frozenset(слов)
+        self.inactive = set()  # заблокировали бота — не получают рассылку
+        self.matcher = KeywordMatcher(whole_words=KEYWORD_WHOLE_WORDS)
+        self._ids = {}         # один объект int на пользователя во всех множествах
+        self._last_change = 0  # последняя применённая запись user_changes
+        self._pruned_at = 0.0
+
+    def _uid(self, user_id):
+        return self._ids.setdefault(user_id, user_id)
+
+    async def load(self):
+        self.subscribers, self.modes, self.keywords, self._ids = {}, {}, {}, {}
+        self.inactive = set()
+        self.matcher = KeywordMatcher(whole_words=KEYWORD_WHOLE_WORDS)
+        async with db_pool.connection() as db:
+            # Позицию журнала берём до чтения таблиц: изменения между ними применятся повторно, это безопасно
+            async with db.execute("SELECT COALESCE(MAX(id), 0) FROM user_changes") as cursor:
+                self._last_change = (await cursor.fetchone())[0]
+            async with db.execute("SELECT user_id, feed_name FROM subscriptions") as cursor:
+                for user_id, feed_name in await cursor.fetchall():
+                    self.subscribe(user_id, feed_name)
+            async with db.execute("SELECT user_id FROM users WHERE active = 0") as cursor:
+                self.inactive = {self._uid(row[0]) for row in await cursor.fetchall()}
+            async with db.execute("SELECT user_id, filter_mode FROM user_settings") as cursor:
+                for user_id, mode in await cursor.fetchall():
+                    self.set_mode(user_id, mode)
+            grouped = {}
+            async with db.execute("SELECT user_id, keyword FROM keywords") as cursor:
+                for user_id, keyword in await cursor.fetchall():
+                    grouped.setdefault(self._uid(user_id), set()).add(sys.intern(keyword))
+            self.keywords = {user_id: frozenset(words) for user_id, words in grouped.items()}
+        # Сборка автомата на сотни тысяч слов — секунды CPU, уносим её из event loop
+        pairs = [(user_id, word) for user_id, words in self.keywords.items() for word in words]
+        matcher = KeywordMatcher(whole_words=KEYWORD_WHOLE_WORDS)
+        await asyncio.to_thread(matcher.add_many, pairs)
+        self.matcher = matcher
+
+    async def refresh(self):
+        """Применяет изменения пользователей из user_changes, сделанные другими процессами."""
+        async with db_pool.connection() as db:
+            async with db.execute("SELECT id, user_id FROM user_changes WHERE id > ? ORDER BY id",
+                                  (self._last_change,)) as cursor:
+                rows = await cursor.fetchall()
+        if rows:
+            self._last_change = rows[-1][0]
+            user_ids = list({user_id for _, user_id in rows})
+            for start in range(0, len(user_ids), 500):
+                await self._reload_users(user_ids[start:start + 500])
+        if time.time() - self._pruned_at > 3600:
+            async with db_pool.transaction() as db:
+                await db.execute("DELETE FROM user_changes WHERE created_at < ?", (time.time() - 24 * 3600,))
+            self._pruned_at = time.time()
+
+    async def _reload_users(self, user_ids):
+        placeholders = ",".join("?" * len(user_ids))
+        async with db_pool.connection() as db:
+            async with db.execute(f"SELECT user_id, feed_name FROM subscriptions WHERE user_id IN ({placeholders})",
+                                  user_ids) as cursor:
+                subscriptions = await cursor.fetchall()
+            async with db.execute(f"SELECT user_id FROM users WHERE active = 0 AND user_id IN ({placeholders})",
+                                  user_ids) as cursor:
+                inactive = [row[0] for row in await cursor.fetchall()]
+            async with db.execute(f"SELECT user_id, filter_mode FROM user_settings WHERE user_id IN ({placeholders})",
+                                  user_ids) as cursor:
+                modes = await cursor.fetchall()
+            async with db.execute(f"SELECT user_id, keyword FROM keywords WHERE user_id IN ({placeholders})",
+                                  user_ids) as cursor:
+                keywords = await cursor.fetchall()
+        # Забываем всё о пользователях и раскладываем заново — так же, как load()
+        forget = set(user_ids)
+        for users in self.subscribers.values():
+            users -= forget
+        for user_id in forget:
+            self.modes.pop(user_id, None)
+            self.clear_keywords(user_id)
+        self.inactive -= forget
+        for user_id, feed_name in subscriptions:
+            self.subscribe(user_id, feed_name)
+        self.inactive.update(self._uid(user_id) for user_id in inactive)
+        for user_id, mode in modes:
+            self.set_mode(user_id, mode)
+        for user_id, keyword in keywords:
+            self.add_keyword(user_id, keyword)
+
+    def subscribe(self, user_id, feed_name):
+        self.subscribers.setdefault(sys.intern(feed_name), set()).add(self._uid(user_id))
+
+    def unsubscribe(self, user_id, feed_name):
+        self.subscribers.get(feed_name, set()).discard(user_id)
+
+    def set_mode(self, user_id, mode):
+        if mode == 'all':
+            self.modes.pop(user_id, None)
+        else:
+            self.modes[self._uid(user_id)] = sys.intern(mode)
+
+    def add_keyword(self, user_id, keyword):
+        user_id = self._uid(user_id)
+        self.keywords[user_id] = self.keywords.get(user_id, frozenset()) | {sys.intern(keyword)}
+        self.matcher.add(user_id, keyword)
+
+    def remove_keyword(self, user_id, keyword):
+        words = self.keywords.get(user_id, frozenset()) - {keyword}
+        self.matcher.remove(user_id, keyword)
+        if words:
+            self.keywords[user_id] = words
+        else:
+            self.keywords.pop(user_id, None)
+
+    def clear_keywords(self, user_id):
+        for keyword in self.keywords.pop(user_id, ()):
+            self.matcher.remove(user_id, keyword)
+
+    def recipients(self, feed_name, search_text):
+        """Кому из подписчиков ленты отправить новость с текстом search_text.
+
+        Возвращает (сразу, в дайджест) — два списка user_id.
+        """
+        result = []
+        digest = []
+        matched = None
+        for user_id in self.subscribers.get(feed_name, ()):
+            if user_id in self.inactive:
+                continue
+            mode = self.modes.get(user_id, 'all')
+            if mode == 'all':
+                # Если режим "Все", отправляем всегда
+                result.append(user_id)
+            elif mode == 'keywords':
+                # Если режим "Слова" — один проход автомата по тексту на всю новость
+                if matched is None:
+                    with metrics.timer("match"):
+                        matched = self.matcher.match(search_text)
+                if user_id in matched:
+                    result.append(user_id)
+            elif mode == 'digest':
+                # Дайджест получает всё из подписок, но пачкой — см. flush_digests()
+                digest.append(user_id)
+        return result, digest
+
+
+users_snapshot = UserSnapshot()
+
+
+# --- Реестр лент ---
+TRACKING_PARAM_RE = re.compile(r"^(utm_\w+|fbclid|gclid|yclid)$")
+
+
+def canonical_url(url):
+    """Канонический вид URL: одна и та же лента не заводится дважды, одна статья узнаётся по ссылке.
+
+    Схема и хост в нижнем регистре, без порта по умолчанию, фрагмента и рекламных меток.
+    Остальной запрос и логин остаются как были: по этому URL ленту и качаем. ValueError — не http(s)-ссылка.
+    """
+    url = url.strip()
+    if "://" not in url:
+        url = "https://" + url
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    if scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError("нужна ссылка http(s)")
+    host = parts.hostname.encode("idna").decode("ascii").lower()
+    if ":" in host:
+        host = f"[{host}]"  # IPv6
+    port = parts.port
+    netloc = host if port in (None, {"http": 80, "https": 443}[scheme]) else f"{host}:{port}"
+    userinfo, at, _ = parts.netloc.rpartition("@")
+    # Пары запроса не перекодируем: ?rss и ?rss= для сервера могут быть разными запросами
+    query = "&".join(pair for pair in parts.query.split("&")
+                     if pair and not TRACKING_PARAM_RE.match(unquote_plus(pair.partition("=")[0])))
+    return urlunsplit((scheme, userinfo + at + netloc, parts.path or "/", query, ""))
+
+
+class Feed(NamedTuple):
+    id: int
+    name: str
+    url: str
+    added_by: int | None = None  # None — лента из RSS_FEEDS, иначе её добавил пользователь
+
+
+class FeedRegistry:
+    """Все ленты из таблицы feeds в памяти: по id, по имени и по каноническому URL.
+
+    Имя ленты — ключ во всех остальных таблицах (subscriptions, seen_entries, outbox).
+    """
+
+    def __init__(self):
+        self.by_id = {}
+        self.by_name = {}
+        self.by_url = {}
+        self._last_id = 0
+
+    async def load(self):
+        self.by_id, self.by_name, self.by_url, self._last_id = {}, {}, {}, 0
+        await self.refresh()
+
+    async def refresh(self):
+        """Дочитывает ленты, добавленные с прошлого раза (в том числе другими процессами)."""
+        async with db_pool.connection() as db:
+            async with db.execute("SELECT id, name, url, added_by FROM feeds WHERE id > ? ORDER BY id",
+                                  (self._last_id,)) as cursor:
+                for row in await cursor.fetchall():
+                    self.add(Feed(*row))
+
+    def add(self, feed):
+        self.by_id[feed.id] = self.by_name[feed.name] = self.by_url[feed.url] = feed
+        self._last_id = max(self._last_id, feed.id)
+
+    def urls(self, names):
+        return {name: self.by_name[name].url for name in names}
+
+    def active(self):
+        """Ленты, которые стоит опрашивать, — те, на которые кто-то подписан. {name: url}"""
+        return {name: feed.url for name, feed in self.by_name.items() if users_snapshot.subscribers.get(name)}
+
+    def unique_name(self, title, url):
+        name = " ".join(title.split())[:FEED_NAME_MAX] or urlsplit(url).hostname
+        if name not in self.by_name:
+            return name
+        name = f"{name} ({urlsplit(url).hostname})"
+        candidate, n = name, 2
+        while candidate in self.by_name:
+            candidate, n = f"{name} #{n}", n + 1
+        return candidate
+
+    def page(self, page):
+        """Страница меню подписок в порядке добавления лент. Возвращает (ленты, номер страницы, всего страниц)."""
+        # Порядок не зависит от подписок — иначе лента «уезжала» бы с текущей страницы после нажатия
+        pages = max(1, math.ceil(len(self.by_id) / FEEDS_PAGE_SIZE))
+        page = min(max(page, 0), pages - 1)
+        ids = sorted(self.by_id)[page * FEEDS_PAGE_SIZE:(page + 1) * FEEDS_PAGE_SIZE]
+        return [self.by_id[feed_id] for feed_id in ids], page, pages
+
+
+feed_registry = FeedRegistry()
+
+
+def is_public_ip(address):
+    return ipaddress.ip_address(address.split("%")[0]).is_global
+
+
+def check_public_url(url):
+    """Схема http(s) и не IP-адрес внутренней сети. Имена хостов проверяет PublicResolver при соединении."""
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError("нужна ссылка http(s)")
+    try:
+        public = is_public_ip(parts.hostname)
+    except ValueError:
+        return  # не IP, а имя
+    if not public:
+        raise ValueError("адрес во внутренней сети")
+
+
+class PublicResolver(aiohttp.ThreadedResolver):
+    """DNS для лент пользователей: отдаёт соединению только публичные адреса.
+
+    Проверка стоит в самом соединении — её не обойти ни редиректом, ни DNS rebinding.
+    """
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        hosts = [h for h in await super().resolve(host, port, family) if is_public_ip(h["host"])]
+        if not hosts:
+            raise OSError(f"{host}: адрес во внутренней сети")
+        return hosts
+
+
+async def ensure_public_host(url):
+    """Не даём пользователям заставить бота ходить во внутреннюю сеть (заранее — ради понятной ошибки)."""
+    check_public_url(url)
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(urlsplit(url).hostname, None)
+    except OSError as e:
+        raise ValueError("хост не найден") from e
+    for *_, sockaddr in infos:
+        if not is_public_ip(sockaddr[0]):
+            raise ValueError("адрес во внутренней сети")
+
+
+async def add_user_feed(user_id, text):
+    """Проверяет ссылку от пользователя, заводит ленту (или находит уже заведённую) и подписывает на неё.
+
+    Возвращает (Feed, новая ли лента). ValueError с текстом для пользователя — ссылка не подходит.
+    """
+    url = canonical_url(text)
+    feed = feed_registry.by_url.get(url)
+    created = False
+    if feed is None:
+        async with db_pool.connection() as db:
+            async with db.execute("SELECT COUNT(*) FROM feeds WHERE added_by = ?", (user_id,)) as cursor:
+                if (await cursor.fetchone())[0] >= FEEDS_MAX_PER_USER:
+                    raise ValueError(f"можно добавить не больше {FEEDS_MAX_PER_USER} лент")
+        await ensure_public_host(url)
+        try:
+            result = await fetch_feed(url, "(new)", untrusted=True)
+        except Exception as e:
+            raise ValueError(f"не удалось скачать ленту ({e.__class__.__name__})") from e
+        if result.feed is None or not result.feed.entries:
+            raise ValueError("по ссылке нет RSS/Atom-ленты")
+        name = feed_registry.unique_name(result.feed.title, url)
+        async with db_pool.transaction() as db:
+            async with db.execute("""
+                INSERT INTO feeds (name, url, added_by, created_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT DO NOTHING RETURNING id
+            """, (name, url, user_id, time.time())) as cursor:
+                row = await cursor.fetchone()
+        if row is not None:
+            feed_registry.add(Feed(row[0], name, url, user_id))
+            created = True
+        else:
+            # Ту же ленту (или имя) только что завёл другой процесс
+            await feed_registry.refresh()
+        feed = feed_registry.by_url.get(url)
+        if feed is None:
+            raise ValueError("не удалось сохранить ленту, попробуйте ещё раз")
+    if feed.name not in await get_user_subscriptions(user_id):
+        await toggle_subscription(user_id, feed.name)
+    return feed, created
+
+
+# --- Уже виденные записи лент ---
+def entry_key(entry):
+    """64-битный отпечаток записи: guid, а если его нет — ссылка (совсем без них — заголовок без разметки)."""
+    # Заголовок нормализуем: feedparser оставляет в нём теги и пробелы, потоковый разбор — нет
+    ident = entry.guid or entry.link or " ".join(HTML_TAG_RE.sub(" ", entry.title).split())
+    return int.from_bytes(hashlib.blake2b(ident.encode(), digest_size=8).digest(), "big", signed=True)
+
+
+class SeenFeed:
+    __slots__ = ("keys",)
+
+    def __init__(self):
+        self.keys = OrderedDict()  # key -> когда последний раз видели в ленте (старые — в начале)
+
+
+class SeenStore:
+    """Ограниченное множество виденных записей на каждую ленту — в памяти и в SQLite.
+
+    Записи, которые всё ещё есть в ленте, каждый опрос «освежаются» и не вытесняются;
+    забываются только пропавшие из ленты дольше SEEN_TTL или сверх SEEN_MAX_PER_FEED.
+    Порядок записей в ленте значения не имеет.
+    """
+
+    def __init__(self):
+        self._feeds = {}
+        self._added = []    # (feed_name, key, seen_at) — ещё не записаны в БД
+        self._evicted = []  # (feed_name, key) — ещё не удалены из БД
+
+    async def load(self):
+        self._feeds = {}
+        async with db_pool.connection() as db:
+            async with db.execute("SELECT feed_name, entry_key FROM seen_entries ORDER BY seen_at") as cursor:
+                rows = await cursor.fetchall()
+        now = time.time()
+        for feed_name, key in rows:
+            self._feed(feed_name).keys[key] = now
+
+    def _feed(self, feed_name):
+        state = self._feeds.get(feed_name)
+        if state is None:
+            state = self._feeds[feed_name] = SeenFeed()
+        return state
+
+    def knows(self, feed_name):
+        return feed_name in self._feeds
+
+    def is_seen(self, feed_name, key):
+        state = self._feeds.get(feed_name)
+        return state is not None and key in state.keys
+
+    def mark(self, feed_name, keys, persisted=False):
+        """Запоминает все записи текущего документа ленты и вытесняет устаревшие.
+
+        persisted=True — новые ключи уже записаны в seen_entries вызывающим (см. enqueue_posts).
+        """
+        now = time.time()
+        state = self._feed(feed_name)
+        for key in keys:
+            if key in state.keys:
+                state.keys.move_to_end(key)
+            elif not persisted:
+                self._added.append((feed_name, key, now))
+            state.keys[key] = now
+
+        current = set(keys)
+        while state.keys:
+            key, seen_at = next(iter(state.keys.items()))
+            if key in current or (len(state.keys) <= SEEN_MAX_PER_FEED and now - seen_at <= SEEN_TTL):
+                break
+            del state.keys[key]
+            self._evicted.append((feed_name, key))
+
+    async def flush(self):
+        """Пишет накопленные изменения в SQLite одной транзакцией."""
+        if not self._added and not self._evicted:
+            return
+        added, evicted = self._added, self._evicted
+        self._added, self._evicted = [], []
+        async with db_pool.transaction() as db:
+            await db.executemany("INSERT OR IGNORE INTO seen_entries (feed_name, entry_key, seen_at) VALUES (?, ?, ?)",
+                                 added)
+            await db.executemany("DELETE FROM seen_entries WHERE feed_name = ? AND entry_key = ?", evicted)
+
+
+seen_store = SeenStore()
+
+
+# --- Похожие новости из разных лент ---
+# MinHash по словам + LSH по полосам: у похожих текстов совпадает хотя бы одна полоса из MINHASH_BANDS
+MINHASH_PRIME = (1 << 61) - 1
+MINHASH_BANDS = 8
+MINHASH_ROWS = 4   # значений в полосе; вероятность стать кандидатом при сходстве s: 1 - (1 - s^4)^8
+_minhash_rng = random.Random(0x6E657773)  # фиксированное зерно: подписи одинаковы во всех процессах
+MINHASH_PARAMS = [(_minhash_rng.randrange(1, MINHASH_PRIME), _minhash_rng.randrange(MINHASH_PRIME))
+                  for _ in range(MINHASH_BANDS * MINHASH_ROWS)]
+WORD_RE = re.compile(r"\w{2,}")
+
+
+def minhash(tokens):
+    """MinHash-подпись множества слов; доля совпавших позиций ≈ коэффициент Жаккара."""
+    hashes = [int.from_bytes(hashlib.blake2b(token.encode(), digest_size=8).digest(), "big") for token in tokens]
+    return tuple(min((a * h + b) % MINHASH_PRIME for h in hashes) for a, b in MINHASH_PARAMS)
+
+
+def similarity(a, b):
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+
+class Story(NamedTuple):
+    id: int
+    seen_at: float
+    url: str
+    fingerprint: tuple | None  # MinHash; None — текст слишком короткий, сравниваем только по ссылке
+    recipients: array      # кому история на самом деле ушла (сразу или в дайджест)
+
+
+def story_fingerprint(entry):
+    """(нормализованная ссылка, MinHash заголовка и описания или None)."""
+    try:
+        url = canonical_url(entry.link) if entry.link else ""
+    except ValueError:
+        url = entry.link
+    text = entry.title + " " + HTML_TAG_RE.sub(" ", entry.summary)
+    tokens = set(WORD_RE.findall(normalize_text(text)))
+    return url, minhash(tokens) if len(tokens) >= DEDUP_MIN_TOKENS else None
+
+
+class StoryIndex:
+    """Недавно разосланные истории за DEDUP_WINDOW: поиск по ссылке и по MinHash (LSH по полосам).
+
+    Хранится только в памяти: после перезапуска окно набирается заново.
+    """
+
+    def __init__(self):
+        self.stories = OrderedDict()  # id -> Story, старые в начале
+        self.by_url = {}              # url -> set(id)
+        self.bands = [{} for _ in range(MINHASH_BANDS)]  # значения полосы -> set(id)
+        self.recipients_total = 0
+        self._next_id = 0
+
+    def _keys(self, story):
+        if story.url:
+            yield self.by_url, story.url
+        if story.fingerprint is not None:
+            for band in range(MINHASH_BANDS):
+                yield self.bands[band], story.fingerprint[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS]
+
+    def find(self, url, fingerprint):
+        """Похожие истории, самые свежие первыми."""
+        now = time.time()
+        self._evict(now)
+        probe = Story(-1, now, url, fingerprint, array("q"))
+        candidates = set()
+        for table, key in self._keys(probe):
+            candidates |= table.get(key, set())
+        matches = []
+        for story_id in candidates:
+            story = self.stories[story_id]
+            if (url and story.url == url) or (fingerprint is not None and story.fingerprint is not None
+                                             and similarity(fingerprint, story.fingerprint) >= DEDUP_SIMILARITY):
+                matches.append(story)
+        matches.sort(key=lambda story: story.id, reverse=True)
+        return matches
+
+    def add(self, url, fingerprint, user_ids):
+        """Запоминает историю и тех, кому она ушла."""
+        self._next_id += 1
+        story = Story(self._next_id, time.time(), url, fingerprint, array("q", user_ids))
+        self.stories[story.id] = story
+        self.recipients_total += len(story.recipients)
+        for table, key in self._keys(story):
+            table.setdefault(key, set()).add(story.id)
+        return story.id
+
+    def remove(self, story_id):
+        story = self.stories.pop(story_id, None)
+        if story is None:
+            return
+        self.recipients_total -= len(story.recipients)
+        for table, key in self._keys(story):
+            ids = table.get(key)
+            if ids is not None:
+                ids.discard(story_id)
+                if not ids:
+                    del table[key]
+
+    def _evict(self, now):
+        while self.stories:
+            story = next(iter(self.stories.values()))
+            if (now - story.seen_at <= DEDUP_WINDOW and len(self.stories) <= DEDUP_MAX_STORIES
+                    and self.recipients_total <= DEDUP_MAX_RECIPIENTS):
+                break
+            self.remove(story.id)
+
+    def already_received(self, matches, user_ids):
+        """Те из user_ids, кто действительно получил (сразу или в дайджест) одну из похожих историй."""
+        candidates = set(user_ids)
+        received = set()
+        for story in matches[:DEDUP_MAX_MATCHES]:
+            received.update(candidates.intersection(story.recipients))
+        return received
+
+
+story_index = StoryIndex()
+
+
+# --- Рассылка: очередь + пул отправителей с учётом лимитов Telegram ---
+class TokenBucket:
+    """Корзина токенов: rate штук в секунду, не больше burst подряд."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, need=1):
+        """Сколько секунд ждать, пока в корзине наберётся need токенов (0 — можно прямо сейчас)."""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        return 0.0 if self.tokens >= need else (need - self.tokens) / self.rate
+
+    def is_full(self):
+        now = time.monotonic()
+        self._refill(now)
+        return now >= self.paused_until and self.tokens >= self.capacity
+
+    async def acquire(self):
+        while (wait := self.delay()) > 0:
+            await asyncio.sleep(wait)
+        self.tokens -= 1
+
+    def try_acquire(self):
+        if self.delay() > 0:
+            return False
+        self.tokens -= 1
+        return True
+
+    def pause(self, seconds):
+        # После 429 обнуляем запас, чтобы не выстрелить пачкой сразу после паузы
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class ChatState:
+    __slots__ = ("bucket", "lock")
+
+    def __init__(self):
+        self.bucket = TokenBucket(SEND_RATE_PER_CHAT, SEND_BURST_PER_CHAT)
+        # Замок держим от ожидания токена до отправки — сообщения в чат уходят по порядку
+        self.lock = asyncio.Lock()
+
+
+# --- Полосы Bot API: ответы пользователю вперёд рассылки ---
+LANE_INTERACTIVE = "interactive"
+LANE_BROADCAST = "broadcast"
+# Эти вызовы не тратят лимит сообщений: long polling и служебные запросы
+UNMETERED_METHODS = {"getUpdates", "getMe", "setWebhook", "deleteWebhook", "getWebhookInfo"}
+
+# Полоса текущего вызова; воркеры рассылки выставляют broadcast, всё остальное (хендлеры) — interactive
+api_lane = ContextVar("api_lane", default=LANE_INTERACTIVE)
+
+
+def api_budget(role=None):
+    """Доля SEND_RATE_GLOBAL этого процесса: (вызовов в секунду всего, из них резерв на ответы пользователям).
+
+    Полосы делят лимит только внутри процесса. Между процессами он поделен заранее: копиям,
+    принимающим апдейты, — SEND_INTERACTIVE_SHARE на всех, отправителям — остаток на всех.
+    """
+    role = role or BOT_ROLE
+    interactive = SEND_RATE_GLOBAL * SEND_INTERACTIVE_SHARE / UPDATE_PROCESSES if role in ("all", "bot") else 0.0
+    broadcast = SEND_RATE_GLOBAL * (1 - SEND_INTERACTIVE_SHARE) / SENDER_PROCESSES if role in ("all", "sender") else 0.0
+    return interactive + broadcast, interactive
+
+
+class PriorityLimiter:
+    """Лимит Bot API процесса, поделённый на две полосы.
+
+    Рассылка не трогает последние reserve токенов (секунда интерактивного резерва) и уступает, пока
+    ждёт хоть один интерактивный вызов: ответ на кнопку уходит сразу, а рассылке достаётся весь остаток.
+    """
+
+    def __init__(self, rate, reserve_rate=0.0):
+        self.reserve = math.ceil(reserve_rate)
+        self.bucket = TokenBucket(rate, max(rate, self.reserve + 1))
+        self.broadcast_paused_until = 0.0
+        self.interactive_waiting = 0
+
+    def _broadcast_delay(self):
+        now = time.monotonic()
+        if now < self.broadcast_paused_until:
+            return self.broadcast_paused_until - now
+        if self.interactive_waiting:
+            return 1 / self.bucket.rate
+        return self.bucket.delay(self.reserve + 1)
+
+    async def acquire(self, lane):
+        if lane == LANE_BROADCAST:
+            while (wait := self._broadcast_delay()) > 0:
+                await asyncio.sleep(wait)
+            self.bucket.tokens -= 1
+            return
+        self.interactive_waiting += 1
+        try:
+            await self.bucket.acquire()
+        finally:
+            self.interactive_waiting -= 1
+
+    def pause_broadcast(self, seconds):
+        # Ответам пользователям оставляем резерв, но пачкой после паузы рассылка не выстрелит
+        self.broadcast_paused_until = max(self.broadcast_paused_until, time.monotonic() + seconds)
+        self.bucket.tokens = min(self.bucket.tokens, self.reserve)
+
+
+class ApiLaneMiddleware(BaseRequestMiddleware):
+    """Пропускает каждый вызов Bot API через api_limiter в его полосе."""
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        lane = "unmetered" if name in UNMETERED_METHODS else api_lane.get()
+        metrics.inc("newsbot_api_calls_total", lane=lane)
+        if lane == "unmetered":
+            return await make_request(bot, method)
+        start = time.perf_counter()
+        await api_limiter.acquire(lane)
+        metrics.observe("newsbot_api_wait_seconds", time.perf_counter() - start, lane=lane)
         try:
-            feed = feedparser.parse(feed_url)
-            if not feed.entries:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            # Флуд-контроль на ответе пользователю — бот упёрся в общий лимит, рассылке пора притормозить
+            if lane == LANE_INTERACTIVE:
+                api_limiter.pause_broadcast(e.retry_after)
+            raise
+
+
+api_limiter = PriorityLimiter(*api_budget())
+bot.session.middleware(ApiLaneMiddleware())
+
+
+class DeliveryEngine:
+    """Очередь исходящих сообщений и пул воркеров.
+
+    Общий лимит бота — api_limiter (полоса broadcast), лимит на чат — корзина токенов. TelegramRetryAfter
+    ставит на паузу чат, а если флуд-контроль пришёл сразу по нескольким чатам — всю рассылку.
+    Временные ошибки повторяются с экспоненциальной задержкой, заблокировавшие бота
+    пользователи отключаются навсегда (до следующего /start).
+    """
+
+    def __init__(self, workers=SEND_WORKERS):
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self.chats = {}
+        self.bot = None
+        self._tasks = []
+        self._flood_events = deque()  # (время, chat_id) последних RetryAfter
+        self.stats = {"sent": 0, "retried": 0, "failed": 0, "blocked": 0}
+
+    def start(self, bot):
+        self.bot = bot
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._prune_chats()))
+
+    async def stop(self, drain=True):
+        if drain and self._tasks:
+            await self.queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def send(self, chat_id, text, *, feed_name=None, published=None, done=None, **kwargs):
+        """Ставит сообщение в очередь. feed_name/published — только для метрики задержки доставки.
+
+        done(ok) вызывается по завершении: ok=False — отправить не удалось, стоит повторить позже.
+        """
+        # put() ждёт, если очередь полна — естественное обратное давление на отправителя
+        await self.queue.put((chat_id, text, kwargs, feed_name, published, done))
+
+    async def _worker(self):
+        api_lane.set(LANE_BROADCAST)
+        while True:
+            chat_id, text, kwargs, feed_name, published, done = await self.queue.get()
+            ok = False
+            try:
+                if await self._deliver(chat_id, text, kwargs) and published:
+                    metrics.observe("newsbot_delivery_lag_seconds", max(0.0, time.time() - published),
+                                    buckets=LAG_BUCKETS, feed=feed_label(feed_name))
+                ok = True
+            except Exception as e:
+                self.stats["failed"] += 1
+                metrics.inc("newsbot_sends_total", result="failed")
+                print(f"Ошибка отправки юзеру {chat_id}: {e}")
+            finally:
+                if done is not None:
+                    done(ok)
+                self.queue.task_done()
+
+    async def _deliver(self, chat_id, text, kwargs):
+        """True — доставлено, False — получатель недоступен; исключение — не удалось."""
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = ChatState()
+        async with chat.lock:
+            for attempt in range(SEND_MAX_RETRIES + 1):
+                await chat.bucket.acquire()
+                try:
+                    with metrics.timer("send"):
+                        await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                    self.stats["sent"] += 1
+                    metrics.inc("newsbot_sends_total", result="ok")
+                    return True
+                except TelegramRetryAfter as e:
+                    metrics.inc("newsbot_sends_total", result="retry_after")
+                    self._on_flood(chat_id, chat, e.retry_after)
+                except TelegramForbiddenError:
+                    # Пользователь заблокировал бота — больше ему не пишем
+                    self.stats["blocked"] += 1
+                    metrics.inc("newsbot_sends_total", result="forbidden")
+                    await deactivate_user(chat_id)
+                    return False
+                except (TelegramNetworkError, TelegramServerError) as e:
+                    metrics.inc("newsbot_sends_total", result="transient_error")
+                    if attempt == SEND_MAX_RETRIES:
+                        raise
+                    print(f"Повтор отправки юзеру {chat_id}: {e}")
+                    await asyncio.sleep(min(30.0, 2 ** attempt) * random.uniform(0.5, 1.5))
+                self.stats["retried"] += 1
+            raise RuntimeError(f"не удалось отправить за {SEND_MAX_RETRIES + 1} попыток")
+
+    def _on_flood(self, chat_id, chat, retry_after):
+        chat.bucket.pause(retry_after)
+        now = time.monotonic()
+        events = self._flood_events
+        events.append((now, chat_id))
+        while events and now - events[0][0] > 1.0:
+            events.popleft()
+        # 429 сразу по нескольким чатам — это общий лимит бота, тормозим всю рассылку
+        if len({cid for _, cid in events}) >= SEND_FLOOD_CHATS:
+            api_limiter.pause_broadcast(retry_after)
+
+    async def _prune_chats(self):
+        # Состояние чата нужно только пока он «горячий» — иначе словарь растёт на каждого получателя
+        while True:
+            await asyncio.sleep(60)
+            idle = [cid for cid, chat in self.chats.items() if not chat.lock.locked() and chat.bucket.is_full()]
+            for cid in idle:
+                del self.chats[cid]
+
+
+delivery = DeliveryEngine()
+
+
+# --- Outbox: очередь рассылки в SQLite ---
+class OutgoingPost(NamedTuple):
+    text: str
+    published: float | None
+    recipients: list  # кому отправить сразу
+    digest: list      # кому добавить в дайджест
+    title: str
+    link: str
+    summary: str = ""
+
+
+async def enqueue_posts(feed_name, posts, keys):
+    """Кладёт сообщения в outbox и отмечает записи ленты виденными — в одной транзакции.
+
+    posts — [OutgoingPost], keys — ключи всех записей текущего документа. Заодно посты ложатся в архив.
+    После падения либо есть и задания, и отметки, либо ни того ни другого: пост не теряется
+    и не рассылается повторно.
+    """
+    now = time.time()
+    new_keys = {key for key in keys if not seen_store.is_seen(feed_name, key)}
+    if new_keys or posts:
+        await write_outbox(feed_name, posts, new_keys, now)
+    # Память трогаем только после коммита
+    seen_store.mark(feed_name, keys, persisted=True)
+    outbox_sender.wake()
+
+
+async def write_outbox(feed_name, posts, new_keys, now):
+    async with db_pool.transaction() as db:
+        for post in posts:
+            if post.recipients:
+                await insert_outbox_message(db, feed_name, post.text, post.published, post.recipients, now)
+            if post.digest:
+                await db.executemany(
+                    "INSERT INTO digest_items (user_id, feed_name, title, link, created_at) VALUES (?, ?, ?, ?, ?)",
+                    [(user_id, feed_name, post.title, post.link, now) for user_id in post.digest])
+        await insert_archive(db, [(feed_name, post.title, post.link, post.published, post.summary) for post in posts], now)
+        await db.executemany("INSERT OR IGNORE INTO seen_entries (feed_name, entry_key, seen_at) VALUES (?, ?, ?)",
+                             [(feed_name, key, now) for key in new_keys])
+
+
+async def insert_outbox_message(db, feed_name, text, published, user_ids, now):
+    """Одно сообщение для списка получателей; вызывается внутри открытой транзакции."""
+    cursor = await db.execute(
+        "INSERT INTO outbox_messages (feed_name, text, published, created_at) VALUES (?, ?, ?, ?)",
+        (feed_name, text, published, now))
+    message_id = cursor.lastrowid
+    await db.executemany("INSERT INTO outbox (message_id, user_id) VALUES (?, ?)",
+                         [(message_id, user_id) for user_id in user_ids])
+
+
+class OutboxSender:
+    """Забирает задания из outbox пачками, отдаёт их DeliveryEngine и подтверждает пачками.
+
+    Захват — аренда на OUTBOX_LEASE секунд: если процесс упал, не подтверждённые задания
+    заберёт другой отправитель (или этот же после перезапуска). Доставка — «хотя бы один раз»:
+    повтор возможен только для сообщений, отправленных прямо перед падением.
+    """
+
+    def __init__(self):
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._wake = asyncio.Event()
+        self._acked = []   # id доставленных (или недоставляемых) заданий
+        self._failed = []  # id заданий, которые стоит повторить позже
+        self._task = None
+        self._last_cleanup = 0.0
+        self._last_count = 0.0
+        self.backlog = 0   # заданий outbox, готовых к отправке, — по последнему pending()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self._flush_acks()
+
+    def wake(self):
+        self._wake.set()
+
+    def _done(self, outbox_id, ok):
+        (self._acked if ok else self._failed).append(outbox_id)
+
+    async def _run(self):
+        while True:
+            try:
+                await self._flush_acks()
+                if time.monotonic() - self._last_count > 1:
+                    await self.pending()
+                # Захватываем, только когда очередь доставки почти пуста, — иначе аренда истечёт в очереди
+                if delivery.queue.qsize() < OUTBOX_BATCH and await self._claim() == OUTBOX_BATCH:
+                    continue
+            except Exception as e:
+                print(f"Ошибка outbox: {e}")
+            try:
+                await asyncio.wait_for(self._wake.wait(), OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def _claim(self):
+        now = time.time()
+        async with db_pool.transaction() as db:
+            async with db.execute("""
+                UPDATE outbox SET claimed_by = ?, claimed_until = ?
+                WHERE id IN (SELECT id FROM outbox WHERE claimed_until <= ? ORDER BY claimed_until, id LIMIT ?)
+                RETURNING id, message_id, user_id
+            """, (self.worker_id, now + OUTBOX_LEASE, now, OUTBOX_BATCH)) as cursor:
+                jobs = await cursor.fetchall()
+        if not jobs:
+            return 0
+        message_ids = list({message_id for _, message_id, _ in jobs})
+        placeholders = ",".join("?" * len(message_ids))
+        async with db_pool.connection() as db:
+            async with db.execute(f"SELECT id, feed_name, text, published FROM outbox_messages WHERE id IN ({placeholders})",
+                                  message_ids) as cursor:
+                messages = {row[0]: row[1:] for row in await cursor.fetchall()}
+        # RETURNING не гарантирует порядок — сортируем, чтобы посты в чат шли по порядку
+        jobs.sort()
+        for outbox_id, message_id, user_id in jobs:
+            feed_name, text, published = messages[message_id]
+            await delivery.send(user_id, text, feed_name=feed_name, published=published,
+                                done=partial(self._done, outbox_id))
+        return len(jobs)
+
+    async def _flush_acks(self):
+        now = time.time()
+        cleanup = now - self._last_cleanup > 60
+        if not self._acked and not self._failed and not cleanup:
+            return
+        acked, failed = self._acked, self._failed
+        self._acked, self._failed = [], []
+        async with db_pool.transaction() as db:
+            await db.executemany("DELETE FROM outbox WHERE id = ?", [(i,) for i in acked])
+            await db.executemany("""
+                UPDATE outbox SET attempts = attempts + 1, claimed_by = NULL, claimed_until = ? WHERE id = ?
+            """, [(now + OUTBOX_RETRY_DELAY, i) for i in failed])
+            if failed:
+                await db.execute("DELETE FROM outbox WHERE attempts >= ?", (OUTBOX_MAX_ATTEMPTS,))
+            if cleanup:
+                # Текст больше не нужен, когда по сообщению не осталось заданий
+                await db.execute(
+                    "DELETE FROM outbox_messages WHERE NOT EXISTS (SELECT 1 FROM outbox WHERE message_id = outbox_messages.id)")
+                self._last_cleanup = now
+
+    async def pending(self):
+        """Сколько заданий ждут отправки прямо сейчас (без отложенных на повтор)."""
+        async with db_pool.connection() as db:
+            async with db.execute("SELECT COUNT(*) FROM outbox WHERE claimed_until <= ? OR claimed_by = ?",
+                                  (time.time(), self.worker_id)) as cursor:
+                self.backlog = (await cursor.fetchone())[0]
+        self._last_count = time.monotonic()
+        return self.backlog
+
+    async def drain(self):
+        """Ждёт, пока всё готовое к отправке не будет доставлено и подтверждено."""
+        while True:
+            self.wake()
+            await asyncio.sleep(0)
+            await delivery.queue.join()
+            await self._flush_acks()
+            if not await self.pending():
+                return
+            await asyncio.sleep(0.05)
+
+
+outbox_sender = OutboxSender()
+
+
+# --- Дайджесты ---
+def telegram_len(text):
+    """Длина текста так, как её считает Telegram, — в кодовых единицах UTF-16."""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def clip(text, limit):
+    return text if len(text) <= limit else text[:limit] + "…"
+
+
+def digest_messages(items, header=None):
+    """Собирает новости [(feed_name, title, link)] в сообщения не длиннее TELEGRAM_MAX_MESSAGE."""
+    messages = []
+    current = clip(header or f"📰 Дайджест: {len(items)} новостей", DIGEST_HEADER_MAX) + "\n"
+    has_items = False
+    for feed_name, title, link in items:
+        # Каждую часть новости обрезаем: даже в UTF-16 (до 2 единиц на символ) новость с заголовком
+        # дайджеста помещается в одно сообщение, иначе Telegram отклонит его и оно потеряется
+        block = (f"\n⚡ **{clip(feed_name, FEED_NAME_MAX)}**\n{clip(title, DIGEST_TITLE_MAX)}"
+                 f"\n👉 {clip(link, DIGEST_LINK_MAX)}\n")
+        # Сообщение без единой новости (один заголовок дайджеста) не отправляем
+        if has_items and telegram_len(current) + telegram_len(block) > TELEGRAM_MAX_MESSAGE:
+            messages.append(current.strip())
+            current = ""
+        current += block
+        has_items = True
+    if has_items:
+        messages.append(current.strip())
+    return messages
+
+
+async def flush_digests(force=False):
+    """Переносит созревшие дайджесты в outbox: у кого накопилось DIGEST_MAX_ITEMS или прошёл DIGEST_INTERVAL."""
+    now = time.time()
+    async with db_pool.connection() as db:
+        async with db.execute("""
+            SELECT user_id FROM digest_items GROUP BY user_id
+            HAVING ? OR COUNT(*) >= ? OR MIN(created_at) <= ?
+        """, (force, DIGEST_MAX_ITEMS, now - DIGEST_INTERVAL)) as cursor:
+            due = [row[0] for row in await cursor.fetchall()]
+    sent = 0
+    # Пачками, чтобы не держать блокировку записи надолго
+    for start in range(0, len(due), 500):
+        user_ids = due[start:start + 500]
+        placeholders = ",".join("?" * len(user_ids))
+        async with db_pool.transaction() as db:
+            async with db.execute(f"""
+                SELECT id, user_id, feed_name, title, link FROM digest_items
+                WHERE user_id IN ({placeholders}) ORDER BY id
+            """, user_ids) as cursor:
+                rows = await cursor.fetchall()
+            grouped = {}
+            for _, user_id, feed_name, title, link in rows:
+                grouped.setdefault(user_id, []).append((feed_name, title, link))
+            for user_id, items in grouped.items():
+                for text in digest_messages(items):
+                    # published не передаём: задержка дайджеста намеренная и не должна портить метрику
+                    await insert_outbox_message(db, None, text, None, [user_id], now)
+                    sent += 1
+            await db.executemany("DELETE FROM digest_items WHERE id = ?", [(row[0],) for row in rows])
+    if sent:
+        metrics.inc("newsbot_digests_total", sent)
+        outbox_sender.wake()
+    return sent
+
+
+# --- Архив записей и полнотекстовый поиск ---
+FTS_WORD_RE = re.compile(r"[^\W_]+")  # так же режет на слова токенизатор unicode61
+
+
+def archive_text(title, summary):
+    """Текст для индекса: заголовок + описание без HTML, нормализованные как ключевые слова."""
+    summary = HTML_TAG_RE.sub(" ", summary)[:ARCHIVE_SUMMARY_MAX]
+    return normalize_text(f"{title} {summary}")
+
+
+async def insert_archive(db, entries, now):
+    """Пачка записей [(feed_name, title, link, published, summary)] в архив; внутри открытой транзакции."""
+    if not entries:
+        return
+    # id раздаём сами (транзакция пишущая, BEGIN IMMEDIATE) — так обе таблицы пишутся двумя executemany
+    async with db.execute("SELECT COALESCE(MAX(id), 0) FROM archive") as cursor:
+        base = (await cursor.fetchone())[0] + 1
+    await db.executemany("INSERT INTO archive (id, feed_name, title, link, published, fetched_at) VALUES (?, ?, ?, ?, ?, ?)",
+                         [(base + i, feed_name, title, link, published, now)
+                          for i, (feed_name, title, link, published, _) in enumerate(entries)])
+    await db.executemany("INSERT INTO archive_fts (rowid, text) VALUES (?, ?)",
+                         [(base + i, archive_text(title, summary))
+                          for i, (_, title, _, _, summary) in enumerate(entries)])
+
+
+def fts_query(text, phrase=False, prefix=True):
+    """Запрос FTS5 из пользовательского текста: все слова (или фраза целиком), каждое — как начало слова."""
+    words = FTS_WORD_RE.findall(normalize_text(text))
+    if not words:
+        return None
+    star = "*" if prefix else ""
+    if phrase:
+        return f'"{" ".join(words)}"{star}'
+    return " ".join(f'"{word}"{star}' for word in words)
+
+
+async def search_archive(query, since=None, feed_names=None, limit=SEARCH_RESULTS):
+    """Свежие записи архива под запрос FTS5: [(feed_name, title, link)], новые первыми."""
+    if query is None:
+        return []
+    with metrics.timer("search"):
+        sql = """
+            SELECT a.feed_name, a.title, a.link FROM archive_fts JOIN archive a ON a.id = archive_fts.rowid
+            WHERE archive_fts MATCH ?
+        """
+        params = [query]
+        async with db_pool.connection() as db:
+            if since is not None:
+                # id растут вместе с fetched_at — окно по времени превращается в диапазон rowid для FTS5
+                async with db.execute("SELECT id FROM archive WHERE fetched_at >= ? ORDER BY fetched_at LIMIT 1",
+                                      (since,)) as cursor:
+                    row = await cursor.fetchone()
+                if row is None:
+                    return []
+                sql += " AND archive_fts.rowid >= ?"
+                params.append(row[0])
+            if feed_names is not None:
+                feed_names = list(feed_names)
+                if not feed_names:
+                    return []
+                sql += f" AND a.feed_name IN ({','.join('?' * len(feed_names))})"
+                params += feed_names
+            sql += " ORDER BY archive_fts.rowid DESC LIMIT ?"
+            params.append(limit)
+            async with db.execute(sql, params) as cursor:
+                return await cursor.fetchall()
+
+
+async def keyword_backfill(user_id, keyword):
+    """Что из подписок пользователя за KEYWORD_BACKFILL_HOURS уже подошло бы под новое слово."""
+    query = fts_query(keyword, phrase=True, prefix=not KEYWORD_WHOLE_WORDS)
+    return await search_archive(query, since=time.time() - KEYWORD_BACKFILL_HOURS * 3600,
+                                feed_names=await get_user_subscriptions(user_id))
+
+
+async def prune_archive():
+    """Удаляет записи старше ARCHIVE_RETENTION небольшими транзакциями. Возвращает число удалённых."""
+    cutoff = time.time() - ARCHIVE_RETENTION
+    removed = 0
+    while True:
+        async with db_pool.transaction() as db:
+            async with db.execute("SELECT id FROM archive WHERE fetched_at < ? ORDER BY fetched_at LIMIT ?",
+                                  (cutoff, ARCHIVE_PRUNE_BATCH)) as cursor:
+                ids = [(row[0],) for row in await cursor.fetchall()]
+            await db.executemany("DELETE FROM archive_fts WHERE rowid = ?", ids)
+            await db.executemany("DELETE FROM archive WHERE id = ?", ids)
+        removed += len(ids)
+        if len(ids) < ARCHIVE_PRUNE_BATCH:
+            return removed
+
+
+# --- Разбор лент в пуле процессов ---
+class FeedEntry(NamedTuple):
+    """Только то, что боту нужно от записи ленты — дёшево передавать между процессами."""
+    guid: str
+    link: str
+    title: str
+    summary: str
+    published: float | None  # unix-время публикации
+
+
+class ParsedFeed(NamedTuple):
+    entries: tuple  # FeedEntry, в порядке документа
+    ttl: str | None  # <ttl> канала, минуты
+    partial: bool = False  # потоковый разбор остановился на уже виденных записях
+    title: str = ""  # заголовок канала (нужен, когда пользователь добавляет ленту)
+
+
+def entry_published(entry):
+    """Время публикации записи feedparser (unix-время) или None, если лента его не дала."""
+    parsed = entry.get("published_parsed") or entry.get("updated_parsed")
+    return calendar.timegm(parsed) if parsed else None
+
+
+def parse_feed_bytes(body, response_headers=None):
+    """Разбирает сырой документ ленты в ParsedFeed. Выполняется в процессе пула."""
+    feed = feedparser.parse(body, response_headers=response_headers)
+    entries = tuple(
+        FeedEntry(entry.get("id", ""), entry.get("link", ""), entry.get("title", ""),
+                  entry.get("summary", ""), entry_published(entry))
+        for entry in feed.entries
+    )
+    return ParsedFeed(entries, feed.feed.get("ttl"), title=feed.feed.get("title", ""))
+
+
+parse_pool = None
+
+
+def get_parse_pool():
+    # spawn, а не fork: в родителе уже крутятся потоки aiosqlite и event loop
+    global parse_pool
+    if parse_pool is None:
+        parse_pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return parse_pool
+
+
+def shutdown_parse_pool():
+    global parse_pool
+    if parse_pool is not None:
+        parse_pool.shutdown(wait=False, cancel_futures=True)
+        parse_pool = None
+
+
+async def parse_feed(body, response_headers=None):
+    """Разбор вне event loop: в пуле процессов, а при PARSE_WORKERS = 0 — в потоке."""
+    if not PARSE_WORKERS:
+        return await asyncio.to_thread(parse_feed_bytes, body, response_headers)
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(get_parse_pool(), parse_feed_bytes, body, response_headers)
+    except BrokenProcessPool:
+        # Воркер упал (например, OOM на огромной ленте) — пул пересоздастся при следующем разборе
+        shutdown_parse_pool()
+        raise
+
+
+# --- Потоковый разбор с ранним выходом ---
+HTML_TAG_RE = re.compile(r"<[^>]+>")
+XML_BASE = "{http://www.w3.org/XML/1998/namespace}base"
+RDF_ABOUT = "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}about"
+
+
+def local_name(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+def element_text(elem):
+    # Текст без HTML-разметки: для заголовка в сообщении и для поиска по словам
+    text = "".join(elem.itertext())
+    return " ".join(html.unescape(HTML_TAG_RE.sub(" ", text)).split())
+
+
+def parse_feed_date(value):
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return parsedate_to_datetime(value).timestamp()  # RSS: RFC 822
+    except (TypeError, ValueError):
+        pass
+    try:
+        parsed = datetime.fromisoformat(value)  # Atom: RFC 3339
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def element_to_entry(elem, base=""):
+    """<item> (RSS 0.9x/1.0/2.0) или <entry> (Atom) -> FeedEntry.
+
+    base — xml:base записи: относительные ссылки Atom разрешаем так же, как feedparser.
+    """
+    guid = link = title = summary = ""
+    permalink = False
+    published = None
+    for child in elem:
+        name = local_name(child.tag)
+        if name == "link":
+            href = child.get("href")
+            if href is None:
+                link = link or (child.text or "").strip()
+            elif child.get("rel", "alternate") == "alternate" and not link:
+                link_base = urljoin(base, child.get(XML_BASE)) if child.get(XML_BASE) else base
+                link = urljoin(link_base, href.strip()) if link_base else href.strip()
+        elif name in ("guid", "id") and not guid:
+            guid = (child.text or "").strip()
+            permalink = name == "guid" and child.get("isPermaLink", "true") != "false"
+        elif name == "title":
+            title = element_text(child)
+        elif name in ("description", "summary", "content", "encoded") and not summary:
+            summary = element_text(child)
+        elif name in ("pubDate", "published", "date", "updated") and published is None:
+            published = parse_feed_date(child.text)
+    # Как у feedparser: id записи RSS 1.0 — rdf:about, а guid-постоянная ссылка заменяет отсутствующий <link>
+    guid = guid or elem.get(RDF_ABOUT, "")
+    if permalink and not link:
+        link = guid
+    return FeedEntry(guid, link, title, summary, published)
+
+
+class FeedStream:
+    """Инкрементальный разбор RSS/Atom: документ скармливается кусками, записи отдаются по мере закрытия."""
+
+    def __init__(self):
+        self.parser = ElementTree.XMLPullParser(events=("start", "end"))
+        self.bases = [""]  # стек xml:base открытых элементов
+        self.ttl = None
+
+    def feed(self, chunk):
+        """Записи, дочитанные в этом куске (разбираются лениво). ElementTree.ParseError — документ не XML."""
+        self.parser.feed(chunk)
+        return self._read()
+
+    def close(self):
+        self.parser.close()
+        return self._read()
+
+    def _read(self):
+        for event, elem in self.parser.read_events():
+            if event == "start":
+                base = elem.get(XML_BASE)
+                self.bases.append(urljoin(self.bases[-1], base) if base else self.bases[-1])
                 continue
+            base = self.bases.pop()
+            name = local_name(elem.tag)
+            if name == "ttl":
+                self.ttl = (elem.text or "").strip()
+            elif name in ("item", "entry"):
+                yield element_to_entry(elem, base)
+                elem.clear()  # разобранную запись из дерева выбрасываем сразу
+
+
+async def stream_parse(resp, is_seen):
+    """Читает ответ кусками и разбирает записи по мере поступления.
+
+    Как только подряд встретилось STREAM_STOP_AFTER_SEEN уже виденных записей,
+    остаток документа не читается. Возвращает (ParsedFeed, None). Если документ
+    не разбирается как XML или в нём больше STREAM_INLINE_ENTRIES записей до виденных —
+    (None, всё тело): такой документ разбирается целиком вне event loop.
+    """
+    stream = FeedStream()
+    received = []
+    entries = []
+    seen_in_row = 0
+    size = 0
+    outcome = "fallback"  # невалидный XML (HTML-сущности, мусор в начале) — разберёт снисходительный feedparser
+    try:
+        async for chunk in resp.content.iter_chunked(STREAM_CHUNK_SIZE):
+            size += len(chunk)
+            if size > FETCH_MAX_BYTES:
+                raise ValueError(f"лента больше {FETCH_MAX_BYTES} байт")
+            received.append(chunk)
+            for entry in stream.feed(chunk):
+                entries.append(entry)
+                seen_in_row = seen_in_row + 1 if is_seen(entry_key(entry)) else 0
+                if seen_in_row >= STREAM_STOP_AFTER_SEEN:
+                    metrics.inc("newsbot_stream_parse_total", outcome="early_exit")
+                    return ParsedFeed(tuple(entries), stream.ttl, partial=True), None
+                if len(entries) > STREAM_INLINE_ENTRIES:
+                    break
+            if len(entries) > STREAM_INLINE_ENTRIES:
+                # Лента почти вся новая — остаток не разбираем в event loop, весь документ уйдёт в пул
+                outcome = "handoff"
+                break
+        else:
+            entries.extend(stream.close())
+            metrics.inc("newsbot_stream_parse_total", outcome="full")
+            return ParsedFeed(tuple(entries), stream.ttl), None
+    except ElementTree.ParseError:
+        pass
+    metrics.inc("newsbot_stream_parse_total", outcome=outcome)
+    rest = await read_limited(resp)
+    if size + len(rest) > FETCH_MAX_BYTES:
+        raise ValueError(f"лента больше {FETCH_MAX_BYTES} байт")
+    return None, b"".join(received) + rest
+
+
+def stream_check(feed_name):
+    """Предикат «запись уже видели» для потокового разбора или None — разобрать документ целиком."""
+    if not STREAM_PARSE or not seen_store.knows(feed_name) or not stream_order.get(feed_name):
+        return None
+    polls = stream_polls[feed_name] = stream_polls.get(feed_name, 0) + 1
+    # Изредка читаем ленту целиком: так освежаются записи из хвоста и их не вытеснит по SEEN_TTL
+    if polls % STREAM_FULL_EVERY == 0:
+        return None
+    return partial(seen_store.is_seen, feed_name)
+
+
+def learn_feed_order(feed_name, entries, new_flags):
+    """По целиком прочитанной ленте решает, можно ли читать её с ранним выходом.
+
+    Можно, только если лента кладёт новое наверх: ранний выход на этом документе нашёл бы все
+    новые записи, а без новых — даты идут от свежих к старым. Иначе (oldest-first, новое
+    в середине) лента всегда читается целиком.
+    """
+    if any(new_flags):
+        seen_in_row = 0
+        for i, new in enumerate(new_flags):
+            seen_in_row = 0 if new else seen_in_row + 1
+            if seen_in_row >= STREAM_STOP_AFTER_SEEN:
+                stream_order[feed_name] = not any(new_flags[i + 1:])
+                return
+        stream_order[feed_name] = True
+        return
+    dates = [entry.published for entry in entries if entry.published is not None]
+    if len(dates) >= 2 and dates[0] != dates[-1]:
+        stream_order[feed_name] = dates[0] > dates[-1]
+
+
+stream_polls = {}  # feed_name -> число потоковых опросов
+stream_order = {}  # feed_name -> True, если новые записи лента кладёт наверх (см. learn_feed_order)
+
+
+# --- Загрузка лент (параллельно, с условным GET) ---
+http_session = None
+user_http_session = None  # для лент пользователей: только публичные адреса
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+fetch_semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+# ETag / Last-Modified последнего успешно обработанного ответа: url -> (etag, modified)
+feed_validators = {}
+MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+
+
+class FetchResult(NamedTuple):
+    feed: ParsedFeed | None  # None, если сервер ответил 304
+    validators: tuple   # (etag, last_modified) этого ответа
+    max_age: int | None  # Cache-Control: max-age, сек.
+
+
+async def get_http_session(untrusted=False):
+    # Одна сессия = общий пул соединений (keep-alive, DNS-кэш) на все ленты; ленты пользователей — отдельно
+    global http_session, user_http_session
+    if untrusted:
+        if user_http_session is None or user_http_session.closed:
+            user_http_session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=FETCH_TIMEOUT),
+                connector=aiohttp.TCPConnector(limit=FETCH_CONCURRENCY, ttl_dns_cache=300,
+                                               resolver=PublicResolver()),
+                headers={"User-Agent": USER_AGENT},
+            )
+        return user_http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=FETCH_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit=FETCH_CONCURRENCY, ttl_dns_cache=300),
+            headers={"User-Agent": USER_AGENT},
+        )
+    return http_session
 
-            current_latest_entry = feed.entries[0]
-            current_latest_link = current_latest_entry.link
-            last_saved_link = await get_last_link(feed_name)
-            new_posts = []
 
-            # 1. Собираем новые посты
-            if last_saved_link is None:
-                print(f"🆕 {feed_name}: Первая запись.")
-                new_posts.append(current_latest_entry)
-            elif last_saved_link == current_latest_link:
-                continue
-            else:
-                for entry in feed.entries:
-                    if entry.link == last_saved_link:
-                        break
-                    new_posts.append(entry)
+async def close_http_session():
+    for session in (http_session, user_http_session):
+        if session is not None and not session.closed:
+            await session.close()
 
-            # 2. Рассылка
-            if new_posts:
-                new_posts.reverse()
-                # Получаем всех подписчиков этого канала
-                users = await get_users_for_feed(feed_name)
 
-                print(f"🔥 {feed_name}: {len(new_posts)} новых постов.")
+@asynccontextmanager
+async def open_feed_url(session, url, headers, untrusted):
+    """GET ленты. Для лент пользователей редиректы проходим сами и проверяем каждый адрес."""
+    if not untrusted:
+        async with session.get(url, headers=headers) as resp:
+            yield resp
+        return
+    for _ in range(FETCH_MAX_REDIRECTS + 1):
+        check_public_url(url)
+        async with session.get(url, headers=headers, allow_redirects=False) as resp:
+            location = resp.headers.get("Location") if resp.status in REDIRECT_STATUSES else None
+            if location is None:
+                yield resp
+                return
+        url = str(resp.url.join(yarl.URL(location)))
+    raise ValueError("слишком много редиректов")
+
+
+async def read_limited(resp):
+    """Тело ответа целиком, но не больше FETCH_MAX_BYTES."""
+    if (resp.content_length or 0) > FETCH_MAX_BYTES:
+        raise ValueError(f"лента больше {FETCH_MAX_BYTES} байт")
+    chunks, size = [], 0
+    async for chunk in resp.content.iter_chunked(STREAM_CHUNK_SIZE):
+        size += len(chunk)
+        if size > FETCH_MAX_BYTES:
+            raise ValueError(f"лента больше {FETCH_MAX_BYTES} байт")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+async def fetch_feed(feed_url, feed_name=None, is_seen=None, untrusted=False):
+    """Скачивает ленту с условным GET и возвращает FetchResult.
+
+    С is_seen лента разбирается потоково и дочитывается только до уже виденных записей.
+    untrusted — ленту добавил пользователь: ходим только на публичные адреса.
+    """
+    session = await get_http_session(untrusted)
+    headers = {}
+    etag, modified = feed_validators.get(feed_url, (None, None))
+    if etag:
+        headers["If-None-Match"] = etag
+    if modified:
+        headers["If-Modified-Since"] = modified
+
+    async with fetch_semaphore:
+        try:
+            with metrics.timer("fetch"):
+                async with open_feed_url(session, feed_url, headers, untrusted) as resp:
+                    match = MAX_AGE_RE.search(resp.headers.get("Cache-Control", ""))
+                    max_age = int(match.group(1)) if match else None
+                    if resp.status == 304:
+                        metrics.inc("newsbot_fetch_total", feed=feed_label(feed_name), status="not_modified")
+                        return FetchResult(None, (etag, modified), max_age)
+                    resp.raise_for_status()
+                    response_headers = dict(resp.headers)
+                    validators = (resp.headers.get("ETag"), resp.headers.get("Last-Modified"))
+                    feed = body = None
+                    if is_seen is not None:
+                        feed, body = await stream_parse(resp, is_seen)
+                    else:
+                        body = await read_limited(resp)
+        except Exception:
+            metrics.inc("newsbot_fetch_total", feed=feed_label(feed_name), status="error")
+            raise
+    metrics.inc("newsbot_fetch_total", feed=feed_label(feed_name), status="ok")
+
+    # Полный разбор XML — CPU-работа, уносим из event loop (и из процесса), чтобы не тормозить кнопки
+    if feed is None:
+        with metrics.timer("parse"):
+            feed = await parse_feed(body, response_headers)
+    return FetchResult(feed, validators, max_age)
+
+
+def is_user_feed(feed_name):
+    feed = feed_registry.by_name.get(feed_name)
+    return feed is not None and feed.added_by is not None
+
+
+def feed_label(feed_name):
+    """Метка feed для метрик: встроенные ленты — по имени, пользовательские (и ещё не сохранённые) — общей «user».
+
+    Иначе каждая добавленная пользователем лента заводила бы свои временные ряды без ограничения.
+    """
+    feed = feed_registry.by_name.get(feed_name)
+    return feed_name if feed is not None and feed.added_by is None else "user"
+
+
+async def fetch_all_feeds(feeds):
+    """Качает все ленты сразу. Возвращает {feed_name: FetchResult или Exception}."""
+    names = list(feeds)
+    results = await asyncio.gather(*(fetch_feed(feeds[name], name, stream_check(name), is_user_feed(name))
+                                     for name in names), return_exceptions=True)
+    return dict(zip(names, results))
+
+
+# --- Планировщик опроса лент ---
+class FeedSchedule:
+    __slots__ = ("interval", "failures", "floor", "due")
+
+    def __init__(self, due):
+        self.interval = POLL_DEFAULT_INTERVAL
+        self.failures = 0
+        self.floor = POLL_MIN_INTERVAL  # нижняя граница от <ttl> / Cache-Control
+        self.due = due
+
+
+class FeedScheduler:
+    """Своё время следующего опроса для каждой ленты (куча по due).
+
+    Интервал подстраивается под то, как часто в ленте реально выходят записи,
+    не опускается ниже <ttl> и Cache-Control: max-age, а упавшие ленты
+    откладываются с экспоненциальной задержкой и джиттером. Общее число
+    запросов в секунду ограничено корзиной FETCH_BUDGET_PER_SEC.
+    """
+
+    def __init__(self):
+        self.feeds = {}   # feed_name -> FeedSchedule
+        self._heap = []   # (due, feed_name); устаревшие элементы пропускаются при извлечении
+        self.budget = TokenBucket(FETCH_BUDGET_PER_SEC)
+
+    def sync(self, feed_names):
+        now = time.monotonic()
+        for name in feed_names:
+            if name not in self.feeds:
+                # Новые ленты размазываем по первому интервалу, чтобы не бить все разом
+                self._push(name, FeedSchedule(now + random.uniform(0, 1)))
+        for name in set(self.feeds) - set(feed_names):
+            del self.feeds[name]
+
+    def _push(self, name, schedule):
+        self.feeds[name] = schedule
+        heapq.heappush(self._heap, (schedule.due, name))
+
+    async def due_feeds(self):
+        """Просроченные ленты в пределах бюджета запросов.
+
+        Если срок ещё ни у кого не подошёл — ждёт не дольше секунды и возвращает [].
+        """
+        self._drop_stale()
+        now = time.monotonic()
+        if not self._heap or self._heap[0][0] > now:
+            wait = self._heap[0][0] - now if self._heap else 1.0
+            await asyncio.sleep(min(wait, 1.0))
+            return []
+
+        await self.budget.acquire()
+        self._drop_stale()
+        names = [heapq.heappop(self._heap)[1]]
+        while True:
+            self._drop_stale()
+            if not self._heap or self._heap[0][0] > time.monotonic() or not self.budget.try_acquire():
+                break
+            names.append(heapq.heappop(self._heap)[1])
+        # Пока лента в работе, её нет в куче — повторно не возьмём
+        for name in names:
+            self.feeds[name].due = math.inf
+        return names
+
+    def _drop_stale(self):
+        while self._heap:
+            due, name = self._heap[0]
+            schedule = self.feeds.get(name)
+            if schedule is not None and schedule.due == due:
+                return
+            heapq.heappop(self._heap)
+
+    def _reschedule(self, name, delay):
+        schedule = self.feeds.get(name)
+        if schedule is None:
+            return
+        schedule.due = time.monotonic() + delay
+        heapq.heappush(self._heap, (schedule.due, name))
+
+    def on_success(self, name, result, new_count):
+        schedule = self.feeds.get(name)
+        if schedule is None:
+            return
+        schedule.failures = 0
+        ttl = result.feed.ttl if result.feed is not None else None
+        floors = [POLL_MIN_INTERVAL]
+        if result.max_age:
+            floors.append(result.max_age)
+        if ttl and str(ttl).isdigit():
+            floors.append(int(ttl) * 60)  # <ttl> в RSS — в минутах
+        schedule.floor = min(max(floors), POLL_MAX_INTERVAL)
+
+        gap = median_publish_gap(result.feed.entries) if result.feed is not None else None
+        if gap is not None:
+            # Опрашиваем в несколько раз чаще, чем выходят записи; сглаживаем, чтобы не дёргаться
+            schedule.interval = 0.7 * schedule.interval + 0.3 * gap * POLL_GAP_FRACTION
+        elif new_count:
+            schedule.interval *= 0.8
+        else:
+            schedule.interval *= 1.25
+        schedule.interval = min(max(schedule.interval, schedule.floor), POLL_MAX_INTERVAL)
+        self._reschedule(name, schedule.interval)
 
-                if users:
-                    for entry in new_posts:
-                        # Заголовок и ссылка новости
-                        news_title = entry.title
-                        news_link = entry.link
-                        # Собираем текст для поиска (заголовок + описание, если есть)
-                        search_text = (news_title + " " + getattr(entry, 'summary', '')).lower()
+    def on_failure(self, name):
+        schedule = self.feeds.get(name)
+        if schedule is None:
+            return
+        schedule.failures += 1
+        backoff = min(POLL_BACKOFF_MAX, schedule.interval * 2 ** schedule.failures)
+        self._reschedule(name, backoff * random.uniform(0.8, 1.2))
 
-                        msg_text = f"⚡ **{feed_name}**\n{news_title}\n👉 {news_link}"
 
-                        for user_id in users:
-                            try:
-                                # --- ПРОВЕРКА НАСТРОЕК ЮЗЕРА ---
-                                mode = await get_filter_mode(user_id)
+def median_publish_gap(entries):
+    """Медиана интервалов между публикациями в ленте, сек. None — если дат мало."""
+    stamps = sorted((entry.published for entry in entries if entry.published), reverse=True)[:POLL_LEARN_ENTRIES]
+    gaps = [a - b for a, b in zip(stamps, stamps[1:]) if a > b]
+    if len(gaps) < 3:
+        return None
+    # Если свежих записей давно не было, лента «остыла» — учитываем и время с последней
+    gaps.append(max(0, time.time() - stamps[0]))
+    return statistics.median(gaps)
 
-                                should_send = False
 
-                                if mode == 'all':
-                                    # Если режим "Все", отправляем всегда
-                                    should_send = True
+feed_scheduler = FeedScheduler()
 
-                                elif mode == 'keywords':
-                                    # Если режим "Слова", проверяем совпадения
-                                    user_keywords = await get_user_keywords(user_id)
-                                    # Проверяем, есть ли хоть одно ключевое слово в тексте новости
-                                    if any(kw in search_text for kw in user_keywords):
-                                        should_send = True
 
-                                # Отправляем только если проверка прошла
-                                if should_send:
-                                    await bot.send_message(chat_id=user_id, text=msg_text)
-                                    await asyncio.sleep(0.1)
+# --- Логика проверки новостей (С ФИЛЬТРАЦИЕЙ) ---
+async def check_news(feed_names=None):
+    """Проверяет ленты feed_names (по умолчанию все) и рассылает новые посты."""
+    if feed_names is None:
+        feed_names = list(feed_registry.active())
+    print(f"[{datetime.now().time()}] --- Проверка источников: {len(feed_names)} ---")
+    cycle = {"started_at": time.time(), "feeds": len(feed_names), "errors": 0,
+             "new_entries": 0, "enqueued": 0, "suppressed": 0, "stages": {}}
+    token = current_cycle.set(cycle)
+    try:
+        await run_cycle(feed_names)
+    finally:
+        current_cycle.reset(token)
+        cycle["duration_s"] = round(time.time() - cycle["started_at"], 4)
+        cycle["stages"] = {stage: round(seconds, 4) for stage, seconds in cycle["stages"].items()}
+        cycle["send_queue_depth"] = delivery.queue.qsize()
+        metrics.inc("newsbot_cycles_total")
+        if METRICS_JSON_LOG:
+            write_cycle_log(cycle)
+
+
+async def run_cycle(feed_names):
+    cycle = current_cycle.get()
+    fetched = await fetch_all_feeds(feed_registry.urls(feed_names))
+
+    # Старые курсоры нужны только лентам, которых ещё нет в seen_store (переход со старой схемы)
+    last_links = await get_last_links([name for name in feed_names if not seen_store.knows(name)])
+    try:
+        for feed_name, result in fetched.items():
+            try:
+                if isinstance(result, Exception):
+                    raise result
+                new_count = await process_feed(feed_name, result, last_links.get(feed_name))
+            except Exception as e:
+                print(f"Error {feed_name}: {e}")
+                cycle["errors"] += 1
+                feed_scheduler.on_failure(feed_name)
+            else:
+                cycle["new_entries"] += new_count
+                feed_scheduler.on_success(feed_name, result, new_count)
+    finally:
+        # Все новые/вытесненные записи — одной транзакцией
+        await seen_store.flush()
+
+
+def first_poll_posts(feed_name, entries, last_saved_link):
+    # Лента впервые попала в seen_store: все текущие записи станут виденными,
+    # а разослать нужно то же, что разослала бы старая схема с курсором last_link
+    if last_saved_link is None:
+        print(f"🆕 {feed_name}: Первая запись.")
+        return list(entries[:1])
+    new_posts = []
+    for entry in entries:
+        if entry.link == last_saved_link:
+            return new_posts
+        new_posts.append(entry)
+    # Курсор выпал из окна ленты — не рассылаем всю ленту заново
+    return list(entries[:1])
+
+
+async def process_feed(feed_name, result, last_saved_link):
+    """Находит новые посты в скачанной ленте и ставит их в рассылку. Возвращает число новых."""
+    feed_url = feed_registry.by_name[feed_name].url
+    feed = result.feed
+    # 304 Not Modified — лента не менялась, разбирать нечего
+    if feed is None:
+        return 0
+    if not feed.entries:
+        feed_validators[feed_url] = result.validators
+        return 0
+
+    # 1. Собираем новые посты: всё, чего ещё нет среди виденных (порядок ленты не важен)
+    with metrics.timer("detect"):
+        keys = [entry_key(entry) for entry in feed.entries]
+        if seen_store.knows(feed_name):
+            new_posts = []
+            new_flags = []
+            fresh = set()
+            for entry, key in zip(feed.entries, keys):
+                new = key not in fresh and not seen_store.is_seen(feed_name, key)
+                if new:
+                    fresh.add(key)
+                    new_posts.append(entry)
+                new_flags.append(new)
+            if not feed.partial:
+                learn_feed_order(feed_name, feed.entries, new_flags)
+        else:
+            new_posts = first_poll_posts(feed_name, feed.entries, last_saved_link)
+
+    # 2. Рассылка: задания ложатся в outbox, отправляют их воркеры OutboxSender
+    posts = []
+    stories = []
+    if new_posts:
+        new_posts.reverse()
+
+        print(f"🔥 {feed_name}: {len(new_posts)} новых постов.")
+        metrics.inc("newsbot_new_entries_total", len(new_posts), feed=feed_label(feed_name))
+        cycle = current_cycle.get()
+
+        for entry in new_posts:
+            # Заголовок и ссылка новости
+            news_title = entry.title
+            news_link = entry.link
+            # Собираем текст для поиска (заголовок + описание, если есть)
+            search_text = news_title + " " + entry.summary
+
+            msg_text = f"⚡ **{feed_name}**\n{news_title}\n👉 {news_link}"
+
+            # Получатели считаются по снимку в памяти — без запросов к БД
+            with metrics.timer("recipients"):
+                recipients, digest = users_snapshot.recipients(feed_name, search_text)
+            # Та же история уже приходила из другой ленты (или с другим заголовком) — этим пользователям не шлём
+            if DEDUP:
+                with metrics.timer("dedup"):
+                    url, fingerprint = story_fingerprint(entry)
+                    matches = story_index.find(url, fingerprint)
+                    if matches and (recipients or digest):
+                        received = story_index.already_received(matches, recipients + digest)
+                        before = len(recipients) + len(digest)
+                        recipients = [user_id for user_id in recipients if user_id not in received]
+                        digest = [user_id for user_id in digest if user_id not in received]
+                        suppressed = before - len(recipients) - len(digest)
+                        if suppressed:
+                            metrics.inc("newsbot_dedup_suppressed_total", suppressed, feed=feed_label(feed_name))
+                            if cycle is not None:
+                                cycle["suppressed"] += suppressed
+                    stories.append(story_index.add(url, fingerprint, recipients + digest))
+            posts.append(OutgoingPost(msg_text, entry.published, recipients, digest, news_title, news_link, entry.summary))
+            metrics.inc("newsbot_enqueued_total", len(recipients))
+            if cycle is not None:
+                cycle["enqueued"] += len(recipients)
+
+    # Задания и отметки «виденное» — одной транзакцией: при ошибке повторим в следующем цикле
+    try:
+        with metrics.timer("enqueue"):
+            await enqueue_posts(feed_name, posts, keys)
+    except BaseException:
+        # Не разосланные истории не должны глушить свои же повторы в следующем цикле
+        for story_id in stories:
+            story_index.remove(story_id)
+        raise
+
+    # Валидаторы запоминаем только после успешной обработки,
+    # иначе следующий 304 спрячет непрочитанные посты
+    feed_validators[feed_url] = result.validators
+    return len(new_posts)
 
-                            except Exception as e:
-                                print(f"Ошибка отправки юзеру {user_id}: {e}")
 
-                await set_last_link(feed_name, current_latest_link)
+# --- Фоновая задача ---
+async def monitoring_task():
+    # Каждая лента опрашивается по своему расписанию; пачки просроченных лент работают параллельно
+    running = set()
+    refreshed = time.monotonic()
+    try:
+        while True:
+            # Пользователей могли поменять другие процессы бота — дочитываем их изменения
+            if time.monotonic() - refreshed > STATE_REFRESH_INTERVAL:
+                try:
+                    await users_snapshot.refresh()
+                except Exception as e:
+                    print(f"Ошибка обновления снимка: {e}")
+                refreshed = time.monotonic()
+            # Опрашиваем только ленты с подписчиками: цена цикла зависит от числа уникальных лент, а не пользователей
+            feed_scheduler.sync(feed_registry.active())
+            feed_names = await feed_scheduler.due_feeds()
+            if feed_names:
+                task = asyncio.create_task(check_news(feed_names))
+                running.add(task)
+                task.add_done_callback(running.discard)
+    finally:
+        # Остановка: начатые циклы дописывают outbox и отметки «виденное», иначе посты придут повторно
+        if running:
+            await asyncio.wait(running, timeout=SHUTDOWN_TIMEOUT)
+
+
+async def registry_task():
+    # Ленты, добавленные в других копиях бота: нужны и опросу, и кнопкам sub:<id> в каждой копии
+    while True:
+        await asyncio.sleep(STATE_REFRESH_INTERVAL)
+        try:
+            await feed_registry.refresh()
+        except Exception as e:
+            print(f"Ошибка обновления списка лент: {e}")
+
 
+async def archive_task():
+    while True:
+        try:
+            removed = await prune_archive()
+            if removed:
+                print(f"🗄 Архив: удалено {removed} старых записей.")
         except Exception as e:
-            print(f"Error {feed_name}: {e}")
+            print(f"Ошибка чистки архива: {e}")
+        await asyncio.sleep(3600)
 
 
-# --- Фоновая задача ---
-async def monitoring_task():
+async def digest_task():
     while True:
-        await check_news()
-        # Ждем 60 секунд (или меньше, если хотите еще быстрее)
-        await asyncio.sleep(CHECK_INTERVAL)
+        await asyncio.sleep(DIGEST_CHECK_INTERVAL)
+        try:
+            await flush_digests()
+        except Exception as e:
+            print(f"Ошибка дайджеста: {e}")
+
+
+# --- Webhook ---
+class BoundedRequestHandler(SimpleRequestHandler):
+    """Вебхук aiogram с ограничением одновременно обрабатываемых апдейтов.
+
+    Пока все WEBHOOK_CONCURRENCY слотов заняты, Telegram не получает ответа на новый апдейт
+    и сам придерживает следующие — очередь копится у него, а не в памяти бота.
+    """
+
+    def __init__(self, *args, limit=WEBHOOK_CONCURRENCY, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._slots = asyncio.Semaphore(limit)
+
+    async def _handle_request_background(self, bot, request):
+        await self._slots.acquire()
+        try:
+            return await super()._handle_request_background(bot, request)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    async def _background_feed_update(self, bot, update):
+        try:
+            await super()._background_feed_update(bot, update)
+        finally:
+            self._slots.release()
+
+    async def drain(self, timeout):
+        """Ждёт уже принятые апдейты (не дольше timeout)."""
+        tasks = set(self._background_feed_update_tasks)
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+
+    async def close(self):
+        # Сессию бота закрывает main(): после вебхука ей ещё пользуется рассылка
+        pass
+
+
+async def wait_for_signal():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(sig)
+
+
+async def run_webhook():
+    """Принимает апдейты на WEBHOOK_URL до SIGTERM/SIGINT, затем дожидается начатых обработчиков."""
+    handler = BoundedRequestHandler(dp, bot, secret_token=WEBHOOK_SECRET)
+    app = web.Application()
+    handler.register(app, path=urlsplit(WEBHOOK_URL).path or "/")
+    # Проверка живости для балансировщика
+    app.router.add_get("/healthz", lambda request: web.Response(text="ok"))
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    # Копии за балансировщиком ставят один и тот же вебхук — вызов идемпотентный
+    await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, max_connections=min(100, WEBHOOK_CONCURRENCY),
+                          allowed_updates=dp.resolve_used_update_types())
+    print(f"🌐 Вебхук: {WEBHOOK_URL} -> {WEBHOOK_HOST}:{WEBHOOK_PORT}")
+    try:
+        await wait_for_signal()
+    finally:
+        # Сначала перестаём принимать апдейты (Telegram отдаст их другой копии или повторит), потом ждём начатые
+        await site.stop()
+        await handler.drain(SHUTDOWN_TIMEOUT)
+        await runner.cleanup()
+
+
+# Режимы фильтрации: значение user_settings.filter_mode -> подпись в уведомлении
+FILTER_MODES = {"all": "Все новости", "keywords": "Только по словам", "digest": "Дайджест"}
 
 
 # --- 1. Обновляем команду /start ---
@@ -258,6 +2767,40 @@ async def cmd_start(message: Message):
         reply_markup=keyboard
     )
 
+def subscriptions_keyboard(user_subs, page):
+    """Кнопки меню подписок: страница лент, листалка, «добавить свою» и «назад»."""
+    user_subs = set(user_subs)
+    feeds, page, pages = feed_registry.page(page)
+    # Создаем кнопки: если есть в подписках — крестик, если нет — галочка
+    buttons = [[InlineKeyboardButton(text=f"{'❌' if feed.name in user_subs else '✅'} {feed.name}",
+                                     callback_data=f"sub:{feed.id}:{page}")] for feed in feeds]
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton(text="◀️", callback_data=f"subs:{page - 1}"))
+        nav.append(InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data="noop"))
+        if page < pages - 1:
+            nav.append(InlineKeyboardButton(text="▶️", callback_data=f"subs:{page + 1}"))
+        buttons.append(nav)
+    buttons.append([InlineKeyboardButton(text="➕ Добавить свою ленту", callback_data="add_feed")])
+    buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+# --- Поиск по архиву: /search слова ---
+@dp.message(F.text.startswith("/search"))
+async def cmd_search(message: Message):
+    text = message.text.removeprefix("/search").strip()
+    if not text:
+        await message.answer("Напишите, что искать: <code>/search биткоин</code>", parse_mode="HTML")
+        return
+    found = await search_archive(fts_query(text))
+    if not found:
+        await message.answer("Ничего не нашлось 🤷‍♂️")
+        return
+    for chunk in digest_messages(found, f"🔎 Найдено: {len(found)}"):
+        await message.answer(chunk)
+
 @dp.callback_query()
 async def generic_callback(call: CallbackQuery, state: FSMContext):
     data = call.data or ""
@@ -265,30 +2808,36 @@ async def generic_callback(call: CallbackQuery, state: FSMContext):
     user_id = call.from_user.id
 
     # Логика для кнопок
-    if data == "subscriptions":
+    if data == "subscriptions" or data.startswith("subs:"):
+        page = int(data.split(":")[1]) if data.startswith("subs:") else 0
         user_subs = await get_user_subscriptions(user_id)
-        # Создаем кнопки: если есть в подписках — крестик, если нет — галочка
-        buttons = [[InlineKeyboardButton(text=f"{'❌' if name in user_subs else '✅'} {name}", callback_data=f"sub:{name}")] for name in RSS_FEEDS]
-        buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")])
-
-        await call.message.edit_text("<b>Управление подписками:</b>",  reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons), parse_mode="HTML")
+        await call.message.edit_text("<b>Управление подписками:</b>",
+                                     reply_markup=subscriptions_keyboard(user_subs, page), parse_mode="HTML")
+        await call.answer()
         return
 
     # --- Обработка клика по подписке ---
     elif data.startswith("sub:"):
-        feed_name = data.split(":", 1)[1]
+        # sub:<id ленты>:<страница>; старые сообщения ещё присылают sub:<название>
+        feed_ref = data.split(":", 1)[1]
+        feed_id, _, page = feed_ref.partition(":")
+        if feed_id.isdigit() and int(feed_id) not in feed_registry.by_id:
+            # Ленту могли добавить в другой копии бота после нашего последнего обновления
+            await feed_registry.refresh()
+        if feed_id.isdigit() and int(feed_id) in feed_registry.by_id:
+            feed_name, page = feed_registry.by_id[int(feed_id)].name, int(page or 0)
+        elif feed_ref in feed_registry.by_name:
+            feed_name, page = feed_ref, 0
+        else:
+            await call.answer("Такой ленты больше нет 🤷‍♂️", show_alert=True)
+            return
         # 1. Переключаем подписку в БД и получаем новый статус (True/False)
         is_subscribed = await toggle_subscription(user_id, feed_name)
         # 2. Получаем актуальный список подписок (чтобы обновить иконки на кнопках)
         user_subs = await get_user_subscriptions(user_id)
-        # 3. Перерисовываем кнопки (теперь у нажатого источника сменится значок)
-        buttons = [
-            [InlineKeyboardButton(text=f"{'❌' if name in user_subs else '✅'} {name}", callback_data=f"sub:{name}")] for
-            name in RSS_FEEDS]
-        buttons.append([InlineKeyboardButton(text="🔙 Назад в меню", callback_data="main_menu")])
-        # 4. Формируем текст уведомления
-        if is_subscribed: status_line = f"<b>Вы подключили {feed_name}! ✅</b>"
-        else: status_line = f"<b>Вы отключили {feed_name}. ❌</b>"
+        # 3. Формируем текст уведомления
+        if is_subscribed: status_line = f"<b>Вы подключили {html.escape(feed_name)}! ✅</b>"
+        else: status_line = f"<b>Вы отключили {html.escape(feed_name)}. ❌</b>"
         # Собираем полный текст: Статус + Стандартное меню
         full_text = (
             f"{status_line}\n\n"
@@ -296,13 +2845,19 @@ async def generic_callback(call: CallbackQuery, state: FSMContext):
             "<b>✅ — подписаться</b>\n"
             "<b>❌ — отписаться</b>\n"
         )
-        # 5. Обновляем сообщение
+        # 4. Обновляем сообщение (кнопки той же страницы, у нажатого источника сменится значок)
         await call.message.edit_text(
             text=full_text,
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons),
+            reply_markup=subscriptions_keyboard(user_subs, page),
             parse_mode="HTML"
         )
-        await call.answer()
+
+    elif data == "add_feed":
+        await state.set_state(Form.waiting_for_feed_url)
+        await call.message.edit_text("Пришлите ссылку на RSS или Atom-ленту (например: <code>https://habr.com/ru/rss/all/</code>):",
+                                     reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                                         [InlineKeyboardButton(text="🔙 Отмена", callback_data="subscriptions")]]),
+                                     parse_mode="HTML")
 
     # --- МЕНЮ СЛОВ ---
     elif data == "keywords" or data.startswith("del:"):
@@ -382,9 +2937,12 @@ async def generic_callback(call: CallbackQuery, state: FSMContext):
         # Если нажали на кнопку смены режима
         if data.startswith("set_mode:"):
             new_mode = data.split(":")[1]
+            if new_mode not in FILTER_MODES:
+                await call.answer()
+                return
             await set_filter_mode(user_id, new_mode)
             # Можно показать маленькое уведомление
-            mode_text = "Все новости" if new_mode == "all" else "Только по словам"
+            mode_text = FILTER_MODES[new_mode]
             await call.answer(f"Режим изменен: {mode_text} ✅")
         # Получаем текущий режим
         current_mode = await get_filter_mode(user_id)
@@ -392,16 +2950,20 @@ async def generic_callback(call: CallbackQuery, state: FSMContext):
         # Если режим 'all', ставим галочку там, иначе пустой кружок
         btn_all_text = "🟢 Все новости (Поток)" if current_mode == "all" else "⚪️ Все новости (Поток)"
         btn_kw_text = "🟢 Только по словам" if current_mode == "keywords" else "⚪️ Только по словам"
+        btn_digest_text = "🟢 Дайджест" if current_mode == "digest" else "⚪️ Дайджест"
         btns = [
             [InlineKeyboardButton(text=btn_all_text, callback_data="set_mode:all")],
             [InlineKeyboardButton(text=btn_kw_text, callback_data="set_mode:keywords")],
+            [InlineKeyboardButton(text=btn_digest_text, callback_data="set_mode:digest")],
             [InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")]
         ]
         text = (
             "<b>⚙️ Настройки фильтрации</b>\n\n"
             "Выберите, какие новости вы хотите получать из ваших подписок:\n\n"
             "📡 <b>Все новости:</b> Присылает всё подряд из источников, на которые вы подписаны.\n"
-            "🔑 <b>Только по словам:</b> Бот молчит, пока в новости не появится одно из ваших ключевых слов."
+            "🔑 <b>Только по словам:</b> Бот молчит, пока в новости не появится одно из ваших ключевых слов.\n"
+            f"📰 <b>Дайджест:</b> Все новости из подписок, но одним сообщением раз в {DIGEST_INTERVAL // 60} минут "
+            f"(или как только наберётся {DIGEST_MAX_ITEMS})."
         )
         # Используем edit_text, но ловим ошибку, если пользователь жмет на уже выбранный режим
         try:
@@ -457,11 +3019,71 @@ async def process_keyword(message: Message, state: FSMContext):
 
     await message.answer(full_text, reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard), parse_mode="HTML")
 
+    # 3. Сразу показываем, что под новое слово уже нашлось в архиве — не ждём следующих новостей
+    if is_added:
+        found = await keyword_backfill(user_id, word)
+        if found:
+            for text in digest_messages(found, f"🔎 «{word}» за последние {KEYWORD_BACKFILL_HOURS} ч.: {len(found)}"):
+                await message.answer(text)
+
+# --- Обработчик: когда юзер присылает ссылку на ленту ---
+@dp.message(Form.waiting_for_feed_url)
+async def process_feed_url(message: Message, state: FSMContext):
+    user_id = message.from_user.id
+    await state.clear()
+    try:
+        feed, created = await add_user_feed(user_id, message.text or "")
+    except ValueError as e:
+        header = f"⚠️ Не получилось добавить ленту: {html.escape(str(e))}."
+    else:
+        if created:
+            header = f"✅ Лента <b>«{html.escape(feed.name)}»</b> добавлена, вы на неё подписаны!"
+        else:
+            header = f"✅ Лента <b>«{html.escape(feed.name)}»</b> уже есть у бота — вы на неё подписаны."
+    user_subs = await get_user_subscriptions(user_id)
+    await message.answer(f"{header}\n\n<b>Управление подписками:</b>",
+                         reply_markup=subscriptions_keyboard(user_subs, 0), parse_mode="HTML")
+
 async def main():
     await init_db()
-    asyncio.create_task(monitoring_task())
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    metrics.gauge("newsbot_send_queue_depth", lambda: delivery.queue.qsize())
+    metrics.gauge("newsbot_active_chats", lambda: len(delivery.chats))
+    metrics.gauge("newsbot_feeds", lambda: len(feed_scheduler.feeds))
+    metrics_runner = await start_metrics_server()
+    sending = BOT_ROLE in ("all", "sender")
+    if sending:
+        # Хвост outbox считает только отправитель — в остальных процессах gauge был бы вечным нулём
+        metrics.gauge("newsbot_outbox_pending", lambda: outbox_sender.backlog)
+        delivery.start(bot)
+        outbox_sender.start()
+    background = []
+    try:
+        if BOT_ROLE != "sender":
+            background.append(asyncio.create_task(registry_task()))
+        if BOT_ROLE != "sender" and RUN_MONITOR:
+            background += [asyncio.create_task(monitoring_task()), asyncio.create_task(digest_task()),
+                           asyncio.create_task(archive_task())]
+        if BOT_ROLE == "sender":
+            # Только рассылка из outbox: апдейты и опрос лент обслуживает процесс с BOT_ROLE=bot
+            await wait_for_signal()
+        elif BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(bot)
+    finally:
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        if sending:
+            await delivery.stop(drain=False)
+            await outbox_sender.stop()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await close_http_session()
+        shutdown_parse_pool()
+        await bot.session.close()
+        await close_db()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,75 @@
+"""Потоковый разбор (FeedStream) и feedparser должны давать одни и те же entry_key.
+
+Любое расхождение означает, что после смены способа разбора вся лента покажется новой и уйдёт в рассылку заново.
+"""
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("BOT_TOKEN", "42:TEST")
+
+import newsbot  # noqa: E402
+
+ATOM = 'xmlns="http://www.w3.org/2005/Atom"'
+RDF = 'xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" xmlns="http://purl.org/rss/1.0/"'
+
+DOCUMENTS = {
+    "rss_guid": '<rss version="2.0"><channel><title>T</title>'
+                '<item><title>A &amp; B</title><link>https://e.org/1</link><guid>urn:1</guid></item>'
+                '<item><title>C</title><guid isPermaLink="true">https://e.org/2</guid></item></channel></rss>',
+    "rss_link_only": '<rss version="2.0"><channel><item><title>A</title><link> https://e.org/1 </link></item>'
+                     '</channel></rss>',
+    "rss_title_only": '<rss version="2.0"><channel><item><title>Hello &lt;b&gt;w&lt;/b&gt;  x</title></item>'
+                      '</channel></rss>',
+    "rss_guid_whitespace": '<rss version="2.0"><channel><item><title>A</title><guid>\n  urn:x  \n</guid></item>'
+                           '</channel></rss>',
+    "rdf": f'<rdf:RDF {RDF}><channel rdf:about="https://e.org/"><title>T</title></channel>'
+           '<item rdf:about="urn:a"><title>A</title><link>https://e.org/a</link></item></rdf:RDF>',
+    "atom_id": f'<feed {ATOM}><title>T</title><entry><id>tag:e.org,2024:1</id><title>A</title>'
+               '<link href="https://e.org/1"/></entry></feed>',
+    "atom_xml_base_feed": f'<feed {ATOM} xml:base="https://e.org/blog/"><title>T</title>'
+                          '<entry><title>A</title><link href="posts/1"/></entry>'
+                          '<entry><title>B</title><link rel="alternate" href="/abs/2"/></entry></feed>',
+    "atom_xml_base_entry": f'<feed {ATOM} xml:base="https://e.org/"><entry xml:base="sub/"><title>A</title>'
+                           '<link href="1.html"/></entry><entry><title>B</title>'
+                           '<link xml:base="https://other.org/x/" href="y"/></entry></feed>',
+    "atom_relative_without_base": f'<feed {ATOM}><entry><title>A</title><link href="/p/1"/></entry></feed>',
+    "atom_enclosure_first": f'<feed {ATOM}><entry><title>A</title><link rel="enclosure" href="https://e.org/a.mp3"/>'
+                            '<link href="https://e.org/1"/></entry></feed>',
+}
+
+
+def stream_entries(body, chunk_size):
+    stream = newsbot.FeedStream()
+    entries = []
+    for offset in range(0, len(body), chunk_size):
+        entries.extend(stream.feed(body[offset:offset + chunk_size]))
+    entries.extend(stream.close())
+    return entries
+
+
+@pytest.mark.parametrize("chunk_size", [7, 1 << 20])
+@pytest.mark.parametrize("name", DOCUMENTS)
+def test_stream_and_feedparser_keys_match(name, chunk_size):
+    body = ('<?xml version="1.0" encoding="utf-8"?>' + DOCUMENTS[name]).encode()
+    expected = [newsbot.entry_key(entry) for entry in newsbot.parse_feed_bytes(body).entries]
+    assert expected
+    assert [newsbot.entry_key(entry) for entry in stream_entries(body, chunk_size)] == expected
+
+
+def entries(count):
+    return [newsbot.FeedEntry(f"urn:{n}", "", f"T{n}", "", None) for n in range(count)]
+
+
+def test_oldest_first_feed_is_read_in_full():
+    # 5 виденных записей, 2 новых дописаны в конец: ранний выход их бы пропустил
+    newsbot.learn_feed_order("oldest", entries(7), [False] * 5 + [True] * 2)
+    assert newsbot.stream_order["oldest"] is False
+
+
+def test_newest_first_feed_allows_early_exit():
+    newsbot.learn_feed_order("newest", entries(7), [True] * 2 + [False] * 5)
+    assert newsbot.stream_order["newest"] is True